@@ -1,175 +1,304 @@
-from concurrent.futures import ALL_COMPLETED
+from concurrent.futures import ALL_COMPLETED, as_completed
 import imp
-from itertools import repeat
 import math
 import numpy as np
 from sklearn.neighbors import KDTree
 import h5py
 from scipy import ndimage as ndi
 from skimage.measure import regionprops
-import scipy.spatial as sptl
-import scipy.sparse as sprs
 import warnings
 import multiprocessing as mp
-from scipy.stats import wasserstein_distance
-from scipy.interpolate import interp1d
 from scipy.spatial.distance import squareform
 from scipy.cluster.hierarchy import linkage, leaves_list
 from sklearn.cluster import DBSCAN
 
+from graph import update_gabriel_graph
+from cache import channel_fits, get_channel, read_dataset, read_volume, write_volume
+from jobs import get_pool, job_status, no_progress, submit
 
-def get_shape_coords(v1, v2, radius, dims, shape):
-    cVolume = np.ones(dims)
-    vec = v2 - v1
-    bounding_box_min = np.maximum(np.minimum(v1, v2) - radius, 0).astype(int)
-    bounding_box_max = np.minimum(np.maximum(v1, v2) + radius, np.array(dims)).astype(int)
-    dist = np.linalg.norm(vec)
+
+def get_shape_bounding_box(v1, v2, radius, dims, shape):
+    v1 = np.asarray(v1, dtype=np.float64)
+    v2 = np.asarray(v2, dtype=np.float64)
     if shape == 'cylinder':
-        cVolume = np.zeros(dims)
-        unit_vec = vec / dist
-        for z in range(bounding_box_min[0], bounding_box_max[0]):
-            for y in range(bounding_box_min[1], bounding_box_max[1]):
-                for x in range(bounding_box_min[2], bounding_box_max[2]):
-                    voxel = np.array([z, y, x])
-                    voxel_vec = voxel - v1
-                    projection = np.dot(unit_vec, voxel_vec)
-                    if 0 <= projection <= dist:
-                        perpendicular_dist = np.linalg.norm(voxel_vec - unit_vec * projection)
-                        if perpendicular_dist <= radius:
-                            cVolume[z, y, x] = 1
+        bounding_box_min = np.maximum(np.minimum(v1, v2) - radius, 0).astype(int)
+        bounding_box_max = np.minimum(np.maximum(v1, v2) + radius, np.array(dims)).astype(int)
     else:
-        dist_mid = dist * 0.5
+        vec = v2 - v1
         mid = v1 + vec * 0.5
-        max_angle = np.arctan(radius / dist_mid)
+        boundry = max(np.linalg.norm(vec) * 0.5, radius) + 1
+        bounding_box_min = np.array([int(max(mid[d] - boundry, 0)) for d in range(3)])
+        bounding_box_max = np.array([int(min(mid[d] + boundry, dims[d])) for d in range(3)])
+    return bounding_box_min, bounding_box_max
 
-        boundry = dist_mid
-        if radius > dist_mid:
-            boundry = radius
 
-        boundry += 1
-
-        z_min = int(max(mid[0] - boundry, 0))
-        z_max = int(min(mid[0] + boundry, cVolume.shape[0]))
+def get_shape_voxels(v1, v2, radius, dims, shape):
+    v1 = np.asarray(v1, dtype=np.float64)
+    v2 = np.asarray(v2, dtype=np.float64)
+    vec = v2 - v1
+    bounding_box_min, bounding_box_max = get_shape_bounding_box(v1, v2, radius, dims, shape)
 
-        y_min = int(max(mid[1] - boundry, 0))
-        y_max = int(min(mid[1] + boundry, cVolume.shape[1]))
+    if np.any(bounding_box_max <= bounding_box_min):
+        return np.empty((0, 3), dtype=int)
 
-        x_min = int(max(mid[2] - boundry, 0))
-        x_max = int(min(mid[2] + boundry, cVolume.shape[2]))
+    # voxel grid of the clipped bounding box only, in C order like np.nonzero
+    voxels = np.stack(np.meshgrid(*[np.arange(bounding_box_min[d], bounding_box_max[d]) for d in range(3)],
+                                  indexing='ij'), axis=-1).reshape(-1, 3)
+    voxel_vecs = voxels - v1
 
-        mask = np.zeros(cVolume.shape)
-        mask[z_min:z_max, y_min:y_max, x_min:x_max] = 1
-        cVolume[mask == 0] = 0
+    # membership is tested on squared quantities (integer valued for integer vertices) instead of
+    # projections, norms and arccos, so ties on the shape boundary are decided exactly
+    dist_sq = vec @ vec
+    dot_v1 = voxel_vecs @ vec
+    if shape == 'cylinder':
+        perpendicular_sq = (voxel_vecs * voxel_vecs).sum(axis=1) * dist_sq - dot_v1 ** 2
+        inside = (dist_sq > 0) & (dot_v1 >= 0) & (dot_v1 <= dist_sq) & (perpendicular_sq <= radius ** 2 * dist_sq)
+    else:
+        # angle <= arctan(radius / dist_mid)  <=>  cos(angle) >= dist / sqrt(dist^2 + 4 radius^2)
+        cone_sq = dist_sq + 4 * radius ** 2
+        voxel_vecs2 = voxels - v2
+        dot_v2 = -(voxel_vecs2 @ vec)
+        inside = ((dot_v1 >= 0) & (dot_v1 ** 2 * cone_sq >= dist_sq ** 2 * (voxel_vecs * voxel_vecs).sum(axis=1)) &
+                  (dot_v2 >= 0) & (dot_v2 ** 2 * cone_sq >= dist_sq ** 2 * (voxel_vecs2 * voxel_vecs2).sum(axis=1)))
 
-        for voxel in np.array(np.nonzero(cVolume)).T:
+    return voxels[inside]
 
-            if np.linalg.norm(voxel - v2) == 0 or np.linalg.norm(voxel - v1) == 0:
-                continue
 
-            voxel_vec = voxel - v1
+VOXEL_TO_EDGE_VERSION = 2
 
-            projection = np.dot((v2 - v1) / np.linalg.norm(v2 - v1), voxel_vec)
 
-            angle1 = np.arccos(np.clip(projection / np.linalg.norm(voxel_vec), -1, 1))
+def get_voxel_to_edge(v1, v2, voxels, dims):
+    # ragged (CSR) mapping: voxels[offsets[i]:offsets[i + 1]] are the voxels closest to edge sample i
+    edge_coords = np.linspace(v1, v2, int(np.linalg.norm(v2 - v1)))
+    coord_dtype = np.int16 if max(dims) <= np.iinfo(np.int16).max else np.int32
+    offsets = np.zeros(len(edge_coords) + 1, dtype=np.int32)
+    if len(edge_coords) == 0 or len(voxels) == 0:
+        return np.empty((0, 3), dtype=coord_dtype), offsets
 
-            angle2 = np.arccos(np.clip((np.linalg.norm(v2 - v1) - projection) / np.linalg.norm(voxel - v2), -1, 1))
+    tree = KDTree(edge_coords, metric='euclidean')
+    samples = tree.query(voxels, k=1, return_distance=False)[:, 0]
+    order = np.argsort(samples, kind='stable')
+    offsets[1:] = np.cumsum(np.bincount(samples, minlength=len(edge_coords)))
+    return np.asarray(voxels[order], dtype=coord_dtype), offsets
 
-            if angle1 > max_angle or angle2 > max_angle:
-                cVolume[voxel[0], voxel[1], voxel[2]] = 0
 
-    return cVolume
+def read_voxel_to_edge(node):
+    if isinstance(node, h5py.Dataset):
+        # legacy layout: (n_samples, max_voxels, 3) float array padded with -1
+        padded = node[:]
+        valid = (padded >= 0).all(axis=-1)
+        offsets = np.zeros(padded.shape[0] + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum(valid.sum(axis=1))
+        return padded[valid].astype(np.int32), offsets
+    return node['voxels'][:], node['offsets'][:]
 
 
-def edge_intensities(volume_path, channels, id, radius, thresholds, shape, save=False):
-    channels = list(channels.split(','))
-    result = {}
-    found = False
-    with h5py.File(volume_path, 'r') as f:
-        try:
-            if 'intensities' in f.keys():
-                if id in f['intensities'].keys():
-                    if str(radius) in f['intensities'][id].keys():
-                        voxel_to_edge = f['intensities'][id][str(radius)][:]
-                        found = True
-        except:
-            print('Error')
-            print("id: {}, radius: {}, channels: {}, thresholds: {}, shape: {}".format(id, radius, channels, thresholds,
-                                                                                       shape))
+def write_voxel_to_edge(group, radius, voxels, offsets):
+    node = group.create_group(str(radius))
+    node.attrs['version'] = VOXEL_TO_EDGE_VERSION
+    node.create_dataset('voxels', data=voxels)
+    node.create_dataset('offsets', data=offsets)
 
-        if not found:
-            dims = f['image'][list(f['image'].keys())[0]].shape
-            edge_verteces = f['edges'][int(id) - 1]
-            v1 = f['vertices'][int(edge_verteces[0])]
-            v2 = f['vertices'][int(edge_verteces[1])]
 
-            cVolume = get_shape_coords(v1, v2, radius, dims, shape)
+def edge_voxel_to_edge(f, id, radius, shape):
+    # (voxels, offsets, precomputed) of edge id, from intensities/<id>/<radius> if it was precomputed
+    if 'intensities' in f.keys():
+        if id in f['intensities'].keys():
+            if str(radius) in f['intensities'][id].keys():
+                return read_voxel_to_edge(f['intensities'][id][str(radius)]) + (True,)
 
-            edge_coords = np.linspace(v1, v2, int(np.linalg.norm(v2 - v1)))
-            tree = KDTree(edge_coords, metric='euclidean')
+    dims = f['image'][list(f['image'].keys())[0]].shape
+    edge_verteces = f['edges'][int(id) - 1]
+    v1 = f['vertices'][int(edge_verteces[0])]
+    v2 = f['vertices'][int(edge_verteces[1])]
 
-            voxel_to_edge = np.ones((len(edge_coords), radius * radius * 10, 3)) * -1
+    voxels = get_shape_voxels(v1, v2, radius, dims, shape)
+    return get_voxel_to_edge(v1, v2, voxels, dims) + (False,)
 
-            for voxel in np.array(np.nonzero(cVolume)).T:
-                i = tree.query(voxel.reshape(1, -1), k=1, return_distance=False)[0][0]
-                j = 0
-                while voxel_to_edge[i][j].sum() > 0:
-                    j += 1
-                voxel_to_edge[i][j] = voxel
 
+def edge_intensities(volume_path, channels, id, radius, thresholds, shape, save=False):
+    channels = list(channels.split(','))
     thresholds = [float(t) for t in thresholds.split(',')]
+    with read_volume(volume_path) as f:
+        voxels, offsets, found = edge_voxel_to_edge(f, id, radius, shape)
+    profiles = get_edge_profiles(volume_path, channels, voxels, offsets, thresholds)
 
-    for idx, channel in enumerate(channels):
-        result[channel] = get_edge_intensity_worker(volume_path, channel, voxel_to_edge, thresholds, idx)[1]
-
-    if save:
-        with h5py.File(volume_path, 'a') as f:
-            if 'intensities' not in f.keys():
-                f.create_group('intensities')
-            if id not in f['intensities'].keys():
-                f['intensities'].create_group(id)
-            if str(radius) not in f['intensities'][id].keys():
-                f['intensities'][id].create_dataset(str(radius), data=voxel_to_edge)
+    if save and not found:
+        write_voxel_to_edges(volume_path, [(id, radius, voxels, offsets)])
 
-    result = {f'{k} ': v for k, v in result.items()}
+    result = {f'{channel} ': profile.tolist() for channel, profile in zip(channels, profiles)}
     return {id: result}
 
 
-def get_edge_intensity_worker(volume_path, channel, voxel_to_edge, thresholds, idx):
-    with h5py.File(volume_path, 'r') as h5f_cube:
-        result = []
-        intensity_volume = h5f_cube['image'][channel][:]
-        intensity_volume = np.where(intensity_volume > thresholds[idx], intensity_volume, 0)
-        print(voxel_to_edge.shape[0])
-        for i in range(voxel_to_edge.shape[0]):
-            edge_point = voxel_to_edge[i]
-            result.append(0)
-            voxels = [v for v in edge_point if v.sum() > 0]
-            for voxel in voxels:
-                x = int(voxel[0])
-                y = int(voxel[1])
-                z = int(voxel[2])
-                result[i] += intensity_volume[x, y, z]
-
-    result = np.array(result)
-    if np.max(result) > 0:
-        result = np.array(result, np.float32) / np.array(np.max(result), np.float32)
-    result = result.tolist()
-    return channel, result
-
-
-def all_edge_intensities(volumePath, channels, radius, thresholds, shape, save=False):
-    with h5py.File(volumePath, 'r') as f:
-        if 'edges' not in f.keys():
-            return "No edges found!", 200
-        l_edges = len(f['edges'])
+def get_edge_profiles(volume_path, channels, voxels, offsets, thresholds):
+    # (channels, samples) profile of one edge: the edge voxels of each channel summed per edge sample with a
+    # bincount, only the bounding box of the voxels is read
+    n_samples = len(offsets) - 1
+    profiles = np.zeros((len(channels), n_samples), dtype=np.float32)
+    if len(voxels) == 0:
+        return profiles
+    sample_ids = np.repeat(np.arange(n_samples), np.diff(offsets))
+    box_min = voxels.min(axis=0).astype(int)
+    box_max = voxels.max(axis=0).astype(int) + 1
+    local_voxels = tuple((voxels - box_min).astype(np.intp).T)
+
+    for c, (channel, threshold) in enumerate(zip(channels, thresholds)):
+        block = _channel_block(volume_path, channel, threshold, box_min, box_max, len(channels))
+        profiles[c] = np.bincount(sample_ids, weights=block[local_voxels], minlength=n_samples)
+    maxima = profiles.max(axis=1, keepdims=True)
+    return np.divide(profiles, maxima, out=profiles, where=maxima > 0)
+
+
+# edge sets up to this size are read edge by edge instead of in z-slabs over the whole volume
+FEW_EDGES = 64
+
+
+def edge_profiles(volume_path, channels, ids, radius, thresholds, shape, save=False):
+    # (channels, samples) profile of every edge index in ids, keyed by edge index
+    ids = np.unique(np.asarray(ids, dtype=int))
+    if len(ids) > FEW_EDGES:
+        return all_edge_profiles(volume_path, channels, radius, thresholds, shape, save, ids=ids)
+    profiles = {}
+    to_save = []
+    for index in ids:
+        with read_volume(volume_path) as f:
+            voxels, offsets, found = edge_voxel_to_edge(f, str(index + 1), radius, shape)
+        profiles[index] = get_edge_profiles(volume_path, channels, voxels, offsets, thresholds)
+        if save and not found:
+            to_save.append((str(index + 1), radius, voxels, offsets))
+    write_voxel_to_edges(volume_path, to_save)
+    return profiles
+
+
+EDGE_BATCH_SIZE = 256
+SLAB_MAX_BYTES = 2 ** 31
+
+
+def _edge_batch_voxels(batch, radius, dims, shape):
+    # voxel to edge sample mapping of every (index, v1, v2) edge of the batch, only geometry so it can run in
+    # the worker pool while the intensities are read by the caller
+    return [(index,) + get_voxel_to_edge(v1, v2, get_shape_voxels(v1, v2, radius, dims, shape), dims)
+            for index, v1, v2 in batch]
+
+
+def _channel_block(volume_path, channel, threshold, box_min, box_max, count=1):
+    # thresholded box of a channel, from the channel cache if count channels of this size fit into it
+    box = tuple(slice(lo, hi) for lo, hi in zip(box_min, box_max))
+    if channel_fits(volume_path, channel, count):
+        return get_channel(volume_path, channel, threshold)[box]
+    with read_volume(volume_path) as f:
+        block = f['image'][channel][box]
+    return np.where(block > threshold, block, 0)
+
+
+def all_edge_intensities(volumePath, channels, radius, thresholds, shape, save=False, n_jobs=None,
+                         max_bytes=SLAB_MAX_BYTES):
+    channels = list(channels.split(','))
+    thresholds = [float(t) for t in thresholds.split(',')]
+    if read_dataset(volumePath, 'edges') is None:
+        return "No edges found!", 200
+    profiles = all_edge_profiles(volumePath, channels, radius, thresholds, shape, save, n_jobs, max_bytes)
 
     result = {}
-    for i in range(l_edges):
-        result.update(edge_intensities(volumePath, channels, str(i + 1), radius, thresholds, shape, save))
-
+    for index in range(len(profiles)):
+        result[str(index + 1)] = {f'{channel} ': profiles[index][c].tolist() for c, channel in enumerate(channels)}
     return result
 
 
+def all_edge_profiles(volumePath, channels, radius, thresholds, shape, save=False, n_jobs=None,
+                      max_bytes=SLAB_MAX_BYTES, ids=None):
+    # (channels, samples) profile of every edge index in ids (all edges if None), keyed by edge index
+    edges = read_dataset(volumePath, 'edges').astype(int)
+    vertices = read_dataset(volumePath, 'vertices')
+    with read_volume(volumePath) as f:
+        dims = f['image'][list(f['image'].keys())[0]].shape
+        indices = np.arange(len(edges)) if ids is None else np.unique(np.asarray(ids, dtype=int))
+
+        precomputed = {}
+        if 'intensities' in f.keys():
+            wanted = set(indices.tolist())
+            for id in f['intensities'].keys():
+                if int(id) - 1 in wanted and str(radius) in f['intensities'][id].keys():
+                    precomputed[int(id) - 1] = read_voxel_to_edge(f['intensities'][id][str(radius)])
+
+    box_min = np.zeros((len(edges), 3), dtype=int)
+    box_max = np.zeros((len(edges), 3), dtype=int)
+    for index in indices:
+        box_min[index], box_max[index] = get_shape_bounding_box(vertices[edges[index, 0]],
+                                                                vertices[edges[index, 1]], radius, dims, shape)
+    for index, (voxels, offsets) in precomputed.items():
+        if index < len(edges) and len(voxels):
+            box_min[index] = voxels.min(axis=0)
+            box_max[index] = voxels.max(axis=0) + 1
+    mid = (vertices[edges[:, 0]] + vertices[edges[:, 1]]).reshape(-1, 3) * 0.5
+
+    # z-slabs of at most max_bytes of one channel: a slab takes the edges that lie entirely within slab_depth
+    # planes of its first edge, edges reaching further are deferred to a later slab (an edge taller than a slab
+    # gets one of its own). Within a slab, batches of neighbouring edges read only their bounding box, one
+    # channel at a time, and the voxel to edge mapping of a batch is shared by all channels
+    slab_depth = max(1, max_bytes // (dims[1] * dims[2] * 4))
+    n_jobs = n_jobs or mp.cpu_count()
+    profiles = {}
+    to_save = {}
+    pending = indices[np.argsort(box_min[indices, 0], kind='stable')]
+    while len(pending):
+        fits = box_max[pending, 0] <= box_min[pending[0], 0] + slab_depth
+        fits[0] = True
+        slab_edges = pending[fits]
+        pending = pending[~fits]
+        slab_edges = slab_edges[np.lexsort((mid[slab_edges, 2], mid[slab_edges, 1]))]
+        batches = [slab_edges[i:i + EDGE_BATCH_SIZE] for i in range(0, len(slab_edges), EDGE_BATCH_SIZE)]
+
+        geometry = [[(index, vertices[edges[index, 0]], vertices[edges[index, 1]]) for index in batch
+                     if index not in precomputed] for batch in batches]
+        if n_jobs > 1 and sum(len(g) > 0 for g in geometry) > 1:
+            pool = get_pool()
+            computed = [pool.submit(_edge_batch_voxels, g, radius, dims, shape) for g in geometry]
+        else:
+            computed = [None] * len(geometry)
+
+        for batch, g, future in zip(batches, geometry, computed):
+            results = future.result() if future is not None else _edge_batch_voxels(g, radius, dims, shape)
+            voxel_to_edges = {index: voxel_to_edge for index, *voxel_to_edge in results}
+            if save:
+                to_save.update(voxel_to_edges)
+            voxel_to_edges.update((index, precomputed[index]) for index in batch if index in precomputed)
+
+            for index in batch:
+                profiles[index] = np.zeros((len(channels), len(voxel_to_edges[index][1]) - 1), dtype=np.float32)
+            occupied = [index for index in batch if len(voxel_to_edges[index][0])]
+            if not occupied:
+                continue
+            lo = np.min([voxel_to_edges[index][0].min(axis=0) for index in occupied], axis=0).astype(int)
+            hi = np.max([voxel_to_edges[index][0].max(axis=0) for index in occupied], axis=0).astype(int) + 1
+            gather = {}
+            for index in occupied:
+                voxels, offsets = voxel_to_edges[index]
+                n_samples = len(offsets) - 1
+                gather[index] = (tuple((voxels - lo).astype(np.intp).T),
+                                 np.repeat(np.arange(n_samples), np.diff(offsets)), n_samples)
+            for c, (channel, threshold) in enumerate(zip(channels, thresholds)):
+                block = _channel_block(volumePath, channel, threshold, lo, hi, len(channels))
+                for index, (local, sample_ids, n_samples) in gather.items():
+                    profiles[index][c] = np.bincount(sample_ids, weights=block[local], minlength=n_samples)
+
+            for index in occupied:
+                maxima = profiles[index].max(axis=1, keepdims=True)
+                np.divide(profiles[index], maxima, out=profiles[index], where=maxima > 0)
+
+    if save and to_save:
+        with write_volume(volumePath, datasets=['intensities']) as f:
+            if 'intensities' not in f.keys():
+                f.create_group('intensities')
+            for index, (voxels, offsets) in to_save.items():
+                id = str(index + 1)
+                if id not in f['intensities'].keys():
+                    f['intensities'].create_group(id)
+                if str(radius) not in f['intensities'][id].keys():
+                    write_voxel_to_edge(f['intensities'][id], radius, voxels, offsets)
+    return profiles
+
+
 def calculate_centers(channel):
     if np.unique(channel).shape[0] <= 2:
         channel, _ = ndi.label(channel)
@@ -178,58 +307,80 @@ def calculate_centers(channel):
     return np.array(centers, dtype=int)
 
 
-def get_delaunay_edges(points):
-    tri = sptl.Delaunay(points)
-    lil = sprs.lil_matrix((tri.npoints, tri.npoints))
-
-    indices, indptr = tri.vertex_neighbor_vertices
-    for k in range(tri.npoints):
-        lil.rows[k] = indptr[indices[k]:indices[k + 1]].tolist()
-        lil.data[k] = np.ones_like(lil.rows[k]).tolist()
-
-    coo = lil.tocoo()
-    conns = np.vstack((coo.row, coo.col)).T
-    delaunay_conns = np.sort(conns, axis=1)
-    return delaunay_conns, tri
-
-
-def get_gabriel_graph(tri, delaunay_conns, points, min_dist=10):
-    c = tri.points[delaunay_conns]
-    m = (c[:, 0, :] + c[:, 1, :]) / 2
-    r = np.sqrt(np.sum((c[:, 0, :] - c[:, 1, :]) ** 2, axis=1)) / 2
-    tree = sptl.KDTree(points)
-    n = tree.query(x=m, k=1)[0]
-    g = n >= r * (0.999)
-    gabriel_conns = delaunay_conns[g]
-    edges = []
-    for edge in gabriel_conns:
-        found = False
-        for controll in edges:
-            if controll[0] == edge[0] and controll[1] == edge[1]:
-                found = True
-                break
-        if not found:
-            edges.append(edge)
-    return np.array(edges)
+def update_graph(volume_path, inserted, deleted):
+    # insert the (z, y, x) vertices inserted and remove the vertex indices deleted, then update the Gabriel
+    # graph incrementally; precomputed per-edge and per-node data of untouched edges and vertices is moved
+    # to the new ids. Returns the old -> new vertex and edge index maps (-1 if removed)
+    inserted = np.asarray(inserted, dtype=int).reshape(-1, 3)
+    written = ['vertices', 'edges', 'intensities', 'polarization', 'colocalization', 'cells', 'cell_types']
+    with write_volume(volume_path, datasets=written) as f:
+        vertices = f['vertices'][:]
+        edges = f['edges'][:]
+        keep = np.ones(len(vertices), dtype=bool)
+        keep[np.asarray(deleted, dtype=int)] = False
+        vertex_remap = np.full(len(vertices), -1, dtype=np.int64)
+        vertex_remap[keep] = np.arange(np.count_nonzero(keep))
+
+        points = np.concatenate([vertices[keep], inserted.astype(vertices.dtype)])
+        changed = np.concatenate([vertices[~keep], inserted])
+        new_edges, edge_remap = update_gabriel_graph(points, edges, vertex_remap, changed)
+
+        del f['vertices']
+        del f['edges']
+        f.create_dataset('vertices', data=points, chunks=True, maxshape=(None, 3))
+        f.create_dataset('edges', data=new_edges, chunks=True, maxshape=(None, 2))
 
+        if 'intensities' in f.keys():
+            intensities = f['intensities']
+            for old_id in list(intensities.keys()):
+                if int(old_id) > len(edges) or edge_remap[int(old_id) - 1] < 0:
+                    del intensities[old_id]
+            # surviving edges only move to lower ids, in ascending order the target is always free
+            for old_id in sorted(intensities.keys(), key=int):
+                new_id = str(edge_remap[int(old_id) - 1] + 1)
+                if new_id != old_id:
+                    intensities.move(old_id, new_id)
 
-def get_voxels_within_radius(center, radius, shape):
-    arr = np.zeros(shape)
-
-    # create a meshgrid of indices
-    z, y, x = np.meshgrid(np.arange(arr.shape[0]), np.arange(arr.shape[1]), np.arange(arr.shape[2]), indexing='ij')
-    indices = np.stack([z, y, x], axis=-1)
-
-    # calculate the Euclidean distance between each voxel and the center
-    distances = np.linalg.norm(indices - center, axis=-1)
-
-    # get the boolean array indicating which voxels are within the radius from the center
-    within_radius = distances <= radius
-
-    # get the indices of the voxels that are within the radius from the center
-    indices_within_radius = indices[within_radius]
-
-    return indices_within_radius
+        if 'polarization' in f.keys():
+            for group in f['polarization'].values():
+                if not isinstance(group, h5py.Group):
+                    continue
+                for name, dataset in list(group.items()):
+                    if not isinstance(dataset, h5py.Dataset) or len(dataset.shape) != 4:
+                        continue
+                    table = np.full((len(points),) + dataset.shape[1:], np.nan, dtype=dataset.dtype)
+                    table[:np.count_nonzero(keep)] = dataset[:][keep]
+                    attrs = dict(dataset.attrs)
+                    del group[name]
+                    dataset = group.create_dataset(name, data=table)
+                    dataset.attrs.update(attrs)
+
+        if 'colocalization' in f.keys():
+            for group in f['colocalization'].values():
+                for name, dataset in list(group.items()):
+                    table = np.full((len(new_edges),) + dataset.shape[1:], np.nan, dtype=dataset.dtype)
+                    survives = (edge_remap >= 0)[:len(dataset)]
+                    table[edge_remap[:len(dataset)][survives]] = dataset[:][survives]
+                    attrs = dict(dataset.attrs)
+                    del group[name]
+                    dataset = group.create_dataset(name, data=table, chunks=True, maxshape=(None,) + table.shape[1:])
+                    dataset.attrs.update(attrs)
+
+        if 'cells/vertex_cell' in f and len(f['cells/vertex_cell']) == len(vertices):
+            labels = f['image'][f['cells/features'].attrs['labels']]
+            inside = np.all((inserted >= 0) & (inserted < labels.shape), axis=1)
+            values = np.zeros(len(inserted), dtype=labels.dtype)
+            values[inside] = [labels[tuple(v)] for v in inserted[inside]]
+            vertex_cell = np.concatenate([f['cells/vertex_cell'][:][keep], cell_rows(values, f['cells/labels'][:])])
+            del f['cells/vertex_cell']
+            f.create_dataset('cells/vertex_cell', data=vertex_cell)
+
+        if 'cell_types' in f.keys() and len(f['cell_types']) == len(vertices):
+            cell_types = f['cell_types'][:]
+            del f['cell_types']
+            f.create_dataset('cell_types', data=np.concatenate(
+                [cell_types[keep], np.zeros(len(inserted), dtype=cell_types.dtype)]))
+    return vertex_remap, edge_remap
 
 
 def calculate_angles(voxels, center):
@@ -244,201 +395,497 @@ def calculate_angles(voxels, center):
     return angles_percent
 
 
-def get_polarizations(volumePath, edge_ids, channel, radius, threshold):
-    centers = []
+SECTORS = 12
+SECTOR_WIDTH = 8.3
+POLARIZATION_MODES = ['2d', '3d']
+# the 12 vertices of an icosahedron in (z, y, x), each the center of one spherical sector in 3d mode
+_golden = (1 + 5 ** 0.5) / 2
+ICOSAHEDRON = np.array([[_golden * s1, 0, s2] for s1 in (1, -1) for s2 in (1, -1)] +
+                       [[s1, _golden * s2, 0] for s1 in (1, -1) for s2 in (1, -1)] +
+                       [[0, s1, _golden * s2] for s1 in (1, -1) for s2 in (1, -1)])
+_sector_templates = {}
+
+
+def sector_labels(angles_percent):
+    # index a of the sector with a * 8.3 <= angle < a * 8.3 + 8.3, angles past the last sector get SECTORS
+    labels = np.floor(angles_percent / SECTOR_WIDTH).astype(int)
+    labels[angles_percent < labels * SECTOR_WIDTH] -= 1
+    labels[angles_percent >= labels * SECTOR_WIDTH + SECTOR_WIDTH] += 1
+    return np.minimum(labels, SECTORS)
+
+
+def spherical_labels(offsets):
+    # (rows, labels, weights): the icosahedron vertices closest in direction to each (non-zero) offset. Many grid
+    # offsets are equally close to two or more vertices, their weight is split evenly across the tied sectors
+    dots = offsets @ ICOSAHEDRON.T
+    tied = dots >= dots.max(axis=1, keepdims=True) - 1e-9 * (1 + np.abs(offsets).sum(axis=1, keepdims=True))
+    rows, labels = np.nonzero(tied)
+    return rows, labels, 1 / tied.sum(axis=1)[rows]
+
+
+def get_sector_template(radius, mode='2d'):
+    # offsets of all voxels within radius of a center voxel, their sector labels and weights, computed once per
+    # radius; 2d bins the xy angle like calculate_angles, 3d bins the direction on the sphere (the center is
+    # dropped) and lists an offset once per sector it is tied between
+    key = (radius, mode)
+    if key not in _sector_templates:
+        r = int(np.floor(radius))
+        grid = np.arange(-r, r + 1)
+        dz, dy, dx = np.meshgrid(grid, grid, grid, indexing='ij')
+        inside = dz ** 2 + dy ** 2 + dx ** 2 <= radius ** 2
+        offsets = np.stack([dz[inside], dy[inside], dx[inside]], axis=1)
+        if mode == '2d':
+            labels = sector_labels(calculate_angles(offsets, np.zeros(3, dtype=int)))
+            keep = labels < SECTORS
+            offsets, labels = offsets[keep], labels[keep]
+            weights = np.ones(len(offsets))
+        elif mode == '3d':
+            offsets = offsets[np.any(offsets != 0, axis=1)]
+            rows, labels, weights = spherical_labels(offsets)
+            offsets = offsets[rows]
+        else:
+            raise ValueError("Invalid polarization mode")
+        for array in (offsets, labels, weights):
+            array.flags.writeable = False
+        _sector_templates[key] = (offsets, labels, weights)
+    return _sector_templates[key]
+
+
+def sector_sizes(radius, mode='2d'):
+    # number of voxels in each sector of the template
+    _, labels, weights = get_sector_template(radius, mode)
+    return np.bincount(labels, weights=weights, minlength=SECTORS)
+
+
+def sector_table(cube, centers, radius, mode='2d', max_voxels=2 ** 22):
+    # (len(centers), SECTORS) sums of cube over the sectors of the ball around each center,
+    # centers are processed in chunks of at most max_voxels gathered voxels with one bincount per chunk
+    offsets, labels, weights = get_sector_template(radius, mode)
+    centers = np.asarray(centers, dtype=int).reshape(-1, 3)
+    flat = cube.reshape(-1)
+    table = np.zeros((len(centers), SECTORS))
+    if len(offsets) == 0:
+        return table
+    step = max(1, max_voxels // len(offsets))
+    for start in range(0, len(centers), step):
+        chunk = centers[start:start + step]
+        voxels = chunk[:, None, :] + offsets[None, :, :]
+        inside = np.all((voxels >= 0) & (voxels < cube.shape), axis=2)
+        nodes = np.broadcast_to(np.arange(len(chunk))[:, None], inside.shape)[inside]
+        bins = nodes * SECTORS + np.broadcast_to(labels, inside.shape)[inside]
+        index = np.ravel_multi_index(tuple(voxels[inside].T), cube.shape)
+        values = flat[index] * np.broadcast_to(weights, inside.shape)[inside]
+        table[start:start + len(chunk)] = np.bincount(bins, weights=values,
+                                                      minlength=len(chunk) * SECTORS).reshape(-1, SECTORS)
+    return table
+
+
+# version 2 splits voxels tied between spherical sectors
+POLARIZATION_VERSION = 2
+
+
+def polarization_table_name(threshold, mode='2d'):
+    return 'polarization/{}/{}'.format('sectors' if mode == '2d' else 'spherical', float(threshold))
+
+
+def read_polarization_table(volume_path, channel, radius, threshold, mode='2d'):
+    # (n_nodes, SECTORS) slice of a precomputed table, None if it was not precomputed for these parameters
+    name = polarization_table_name(threshold, mode)
+    with read_volume(volume_path) as f:
+        if name not in f:
+            return None
+        dataset = f[name]
+        radii = [int(r) for r in dataset.attrs['radii']]
+        channels = [str(c) for c in dataset.attrs['channels']]
+        if radius not in radii or channel not in channels:
+            return None
+        if mode == '3d' and dataset.attrs.get('version', 1) < POLARIZATION_VERSION:
+            return None
+        return dataset[:, radii.index(radius), channels.index(channel)]
+
+
+def get_polarizations(volumePath, edge_ids, channel, radius, threshold, mode='2d'):
     final_centers = []
     arc_data = []
-    with h5py.File(volumePath, 'r') as f:
-        for id in edge_ids:
-            centers.append(f['edges'][id - 1][0][()])
-            centers.append(f['edges'][id - 1][1][()])
-        centers = np.unique(centers)
-        for node_id in centers:
-            found = False
-            angles = []
-            node_id = str(node_id)
-            if 'polarization' in f.keys():
-                if node_id in f['polarization'].keys():
-                    if str(radius) in f['polarization'][node_id].keys():
-                        angles = f['polarization'][node_id][str(radius)][:]
-                        found = True
-
-            center = f['vertices'][int(node_id)][:]
-            cube = f['image'][channel][:]
-            cube = np.where(cube > threshold, 1, 0)
-            regions = np.zeros((12,))
-            if not found:
-                voxels = get_voxels_within_radius(center, radius, cube.shape)
-                angles = calculate_angles(voxels, center)
-
-            counters = np.zeros(12)
-            for a in range(0, 12, 1):
-                for j, angle in enumerate(angles):
-                    if (a * 8.3) <= angle < (a * 8.3) + 8.3:
-                        regions[a] += cube[voxels[j][0], voxels[j][1], voxels[j][2]]
-
-            #possible_volume = ((4/3) * math.pi * (radius ** 3))/24
-            
-            max = np.max(regions)
-            max = max if max > 0 else 1
-            regions = [math.ceil((a/max) * 10) / 10 for a in regions]
-
-
-            #regions = [min(a, 1) for a in regions]
-
-            corrected_center = [int(center[2] - cube.shape[2] * 0.5), int(center[1] - cube.shape[1] * 0.5),
-                                int(center[0] - cube.shape[0] * 0.5)]
-            final_centers.append(corrected_center)
-            arc_data.append(regions)
+    edges = read_dataset(volumePath, 'edges')
+    vertices = read_dataset(volumePath, 'vertices')
+    centers = np.unique(edges[np.asarray(edge_ids) - 1])
+    with read_volume(volumePath) as f:
+        dims = f['image'][channel].shape
+
+    table = read_polarization_table(volumePath, channel, radius, threshold, mode)
+    if table is not None:
+        sectors = table[centers]
+    else:
+        sectors = np.full((len(centers), SECTORS), np.nan)
+    # rows of vertices added after the table was precomputed are NaN
+    missing = np.any(np.isnan(sectors), axis=1)
+    if missing.any():
+        cube = get_channel(volumePath, channel, threshold, binary=True)
+        sectors[missing] = sector_table(cube, vertices[centers[missing]], radius, mode)
+    if mode == '3d':
+        # share of each spherical sector that is filled, sectors do not hold exactly the same number of voxels
+        sizes = sector_sizes(radius, mode)
+        sectors = np.divide(sectors, sizes, out=np.zeros_like(sectors), where=sizes > 0)
+
+    for node_id, regions in zip(centers, sectors):
+        center = vertices[int(node_id)]
+
+        #possible_volume = ((4/3) * math.pi * (radius ** 3))/24
+        
+        max = np.max(regions)
+        max = max if max > 0 else 1
+        regions = [math.ceil((a/max) * 10) / 10 for a in regions]
+
+
+        #regions = [min(a, 1) for a in regions]
+
+        corrected_center = [int(center[2] - dims[2] * 0.5), int(center[1] - dims[1] * 0.5),
+                            int(center[0] - dims[0] * 0.5)]
+        final_centers.append(corrected_center)
+        arc_data.append(regions)
 
     arc_data = [a for a in arc_data]
     centers = [str(center) for center in centers]
     return [final_centers, arc_data, centers]
 
 
-def get_edge_intensities_rank(volume_path, channels, id, radius, thresholds, shape, save=False, edges=None):
-    primary_edge = edge_intensities(volume_path, channels, str(id), radius, thresholds, shape, save=save)
-    if edges is None:
-        with h5py.File(volume_path, 'r') as f:
-            edges = [i + 1 for i in range(len(f['edges']))]
-    else:
-        edges = [int(i) for i in edges.split(',')]
+def resample_profiles(profiles, length):
+    # list of (channels, n) profiles -> (len(profiles), channels, length) by linear interpolation over the
+    # sample index, done once per distinct profile length
+    n_channels = profiles[0].shape[0] if len(profiles) else 0
+    result = np.zeros((len(profiles), n_channels, length))
+    lengths = np.array([profile.shape[1] for profile in profiles], dtype=int)
+    for n in np.unique(lengths):
+        members = np.flatnonzero(lengths == n)
+        stack = np.stack([profiles[i] for i in members]).astype(np.float64)
+        if n == 1:
+            result[members] = stack
+        elif n > 1:
+            positions = np.linspace(0, n - 1, length)
+            lo = np.minimum(positions.astype(int), n - 2)
+            fraction = positions - lo
+            result[members] = stack[..., lo] * (1 - fraction) + stack[..., lo + 1] * fraction
+    return result
 
-    intensities = {}
-    for i in edges:
-        result = edge_intensities(volume_path, channels, str(i), radius, thresholds, shape, save=save)
-        intensities.update(result)
 
-    fc = list(intensities[str(id)].keys())[0]
-    target_length = len(intensities[str(id)][fc])
+def wasserstein_distances(u, v):
+    # 1D Wasserstein distance between equally weighted samples of the same length along the last axis,
+    # the mean absolute difference of the sorted samples (equal to scipy.stats.wasserstein_distance)
+    return np.mean(np.abs(np.sort(u, axis=-1) - np.sort(v, axis=-1)), axis=-1)
 
-    for edge_id in intensities.keys():
-        edge_dist = 0
-        for channel in intensities[edge_id].keys():
-            target = primary_edge[str(id)][channel] #First get the target channel value
-            val = intensities[str(edge_id)][channel] #Then get the other channel value
-            f = interp1d(np.arange(len(val)), val, kind='linear', fill_value="extrapolate")
-            val_normalized = f(np.linspace(0, len(val) - 1, target_length))
 
-            dist = wasserstein_distance(target, val_normalized) #calculate the distance between them
-            primary_edge[str(id)][channel].reverse() #First get the target channel value
+def get_edge_intensities_rank(volume_path, channels, id, radius, thresholds, shape, save=False, edges=None, k=None):
+    # edges ranked by the summed per-channel Wasserstein distance of their profiles to the profile of edge id,
+    # the profiles of the other edges are resampled to the length of the target profile
+    channels = list(channels.split(','))
+    thresholds = [float(t) for t in thresholds.split(',')]
+    if edges is None:
+        edges = [i + 1 for i in range(len(read_dataset(volume_path, 'edges')))]
+    else:
+        edges = list(dict.fromkeys(int(i) for i in edges.split(',')))
 
-            val = intensities[str(edge_id)][channel] #Then get the other channel value
-            f = interp1d(np.arange(len(val)), val, kind='linear', fill_value="extrapolate")
-            val_normalized = f(np.linspace(0, len(val) - 1, target_length))
+    profiles = edge_profiles(volume_path, channels, np.array(edges + [int(id)]) - 1, radius, thresholds, shape, save)
+    target = profiles[int(id) - 1].astype(np.float64)
+    resampled = resample_profiles([profiles[i - 1] for i in edges], target.shape[1])
+    # the distance only depends on the distribution of values, comparing against the reversed target
+    # as well would give the same result
+    distances = wasserstein_distances(resampled, target[None]).sum(axis=1)
 
-            dist2 = wasserstein_distance(target, val_normalized) #calculate the distance between them
-            edge_dist += min(dist, dist2) #add the distance to the overall edge distance
-        intensities[str(edge_id)]['dist'] = edge_dist
+    order = np.argsort(distances, kind='stable')
+    if k is not None:
+        order = order[:k]
+    return [str(edges[i]) for i in order]
 
-    sorted_intensities = sorted(intensities.items(), key=lambda x: x[1]['dist'])
-    print([(x[0], x[1]['dist']) for x in sorted_intensities])
 
-    sorted_intensities = [x[0] for x in sorted_intensities]
-    return sorted_intensities
+PRECOMPUTE_BATCH_SIZE = 64
+PRECOMPUTE_WRITE_SIZE = 1024
 
 
-def precompute_edge_intensities(volume_path, id, radii, shape):
-    to_remove_radii = []
-    with h5py.File(volume_path, 'r') as f:
-        if 'intensities' in f.keys():
-            if id in f['intensities'].keys():
-                for radius in radii:
+def precompute_edge_intensities(volume_path, ids, radii, shape, progress=no_progress):
+    # ids: edge ids to precompute, None for every edge of the graph
+    with read_volume(volume_path) as f:
+        dims = f['image'][list(f['image'].keys())[0]].shape
+        edges = f['edges'][:].astype(int)
+        vertices = f['vertices'][:]
+        if ids is None:
+            ids = [str(i + 1) for i in range(len(edges))]
+
+        tasks = []
+        for id in ids:
+            for radius in radii:
+                if 'intensities' in f.keys() and id in f['intensities'].keys():
                     if str(radius) in f['intensities'][id].keys():
-                        to_remove_radii.append(radius)
+                        continue
+                v1, v2 = vertices[edges[int(id) - 1]]
+                tasks.append((id, radius, v1, v2))
+
+    # workers only get the edge geometry, the HDF5 file is written by this thread alone in batches
+    pool = get_pool()
+    futures = [pool.submit(precompute_edge_intensity_batch, tasks[i:i + PRECOMPUTE_BATCH_SIZE], dims, shape)
+               for i in range(0, len(tasks), PRECOMPUTE_BATCH_SIZE)]
+    pending = []
+    done = 0
+    for future in as_completed(futures):
+        batch = future.result()
+        pending.extend(batch)
+        done += len(batch)
+        if len(pending) >= PRECOMPUTE_WRITE_SIZE:
+            write_voxel_to_edges(volume_path, pending)
+            pending = []
+        progress(done / len(tasks), 'Precomputed {} of {} edge shapes'.format(done, len(tasks)))
+    write_voxel_to_edges(volume_path, pending)
+    return len(tasks)
+
+
+def precompute_edge_intensity_batch(tasks, dims, shape):
+    result = []
+    for id, radius, v1, v2 in tasks:
+        voxels = get_shape_voxels(v1, v2, radius, dims, shape)
+        result.append((id, radius) + get_voxel_to_edge(v1, v2, voxels, dims))
+    return result
 
-    radii = [x for x in radii if x not in to_remove_radii]
 
-    with mp.Pool(processes=mp.cpu_count()) as pool:
-        result = pool.starmap(precompute_edge_intensity, zip(repeat(volume_path), repeat(id), radii, repeat(shape)))
+def write_voxel_to_edges(volume_path, results):
+    if not results:
+        return
+    with write_volume(volume_path, datasets=['intensities']) as f:
+        intensities = f.require_group('intensities')
+        for id, radius, voxels, offsets in results:
+            group = intensities.require_group(id)
+            if str(radius) not in group.keys():
+                write_voxel_to_edge(group, radius, voxels, offsets)
+
+
+POLARIZATION_THRESHOLDS = [0.1]
+
+
+def precompute_polarizations(volume_path, radii, channels=None, thresholds=POLARIZATION_THRESHOLDS, mode='2d',
+                             progress=no_progress):
+    # sector sums of every vertex for every radius and channel, one (n_nodes, n_radii, n_channels, SECTORS)
+    # float32 table per threshold stored at polarization/sectors/<threshold> (polarization/spherical/ in 3d mode).
+    # Radii and channels already stored in the table are kept, combinations of a stored and a new radius or channel
+    # that were not computed are NaN and filled in on demand like the rows of new vertices
+    vertices = read_dataset(volume_path, 'vertices')
+    with read_volume(volume_path) as f:
+        if channels is None:
+            channels = list(f['image'].keys())
+        stored = {}
+        for threshold in thresholds:
+            name = polarization_table_name(threshold, mode)
+            if name not in f or f[name].shape[0] != len(vertices):
+                continue
+            if mode == '3d' and f[name].attrs.get('version', 1) < POLARIZATION_VERSION:
+                continue
+            stored[name] = ([int(r) for r in f[name].attrs['radii']], [str(c) for c in f[name].attrs['channels']],
+                            f[name][:])
+
+    tables = {}
+    steps = len(thresholds) * len(channels)
+    for t, threshold in enumerate(thresholds):
+        name = polarization_table_name(threshold, mode)
+        table_radii, table_channels, previous = stored.get(name, ([], [], None))
+        table_radii = table_radii + [r for r in radii if r not in table_radii]
+        table_channels = table_channels + [c for c in channels if c not in table_channels]
+        table = np.full((len(vertices), len(table_radii), len(table_channels), SECTORS), np.nan, dtype=np.float32)
+        if previous is not None:
+            table[:, :previous.shape[1], :previous.shape[2]] = previous
+        for c, channel in enumerate(channels):
+            cube = get_channel(volume_path, channel, threshold, binary=True)
+            for radius in radii:
+                table[:, table_radii.index(radius), table_channels.index(channel)] = sector_table(cube, vertices,
+                                                                                                  radius, mode)
+            step = t * len(channels) + c + 1
+            progress(step / steps, 'Precomputed {} of {} channels'.format(step, steps))
+        tables[name] = (table, table_radii, table_channels)
+
+    with write_volume(volume_path, datasets=['polarization']) as f:
+        for name, (table, table_radii, table_channels) in tables.items():
+            if name in f:
+                del f[name]
+            dataset = f.create_dataset(name, data=table)
+            dataset.attrs['radii'] = np.array(table_radii, dtype=int)
+            dataset.attrs['channels'] = np.array(table_channels, dtype=h5py.string_dtype())
+            dataset.attrs['version'] = POLARIZATION_VERSION
+    return len(vertices)
+
+
+CELL_STATS = ['mean', 'sum', 'max', 'fraction']
+CELL_THRESHOLD = 0.1
+CELL_SLAB_BYTES = 2 ** 27
+
+
+def cell_labels(volume_path, labels, depth):
+    # sorted distinct values of the label volume; ingested masks are normalized by their maximum, so cells are
+    # identified by value rather than assuming integer labels
+    values = np.zeros(0)
+    with read_volume(volume_path) as f:
+        dataset = f['image'][labels]
+        for z in range(0, dataset.shape[0], depth):
+            values = np.union1d(values, np.unique(dataset[z:z + depth]))
+    return values
+
+
+def cell_rows(values, cell_labels):
+    # row of cells/features for each label value, -1 for the background and values of no cell
+    values = np.asarray(values)
+    if len(cell_labels) == 0:
+        return np.full(values.shape, -1, dtype=np.int64)
+    rows = np.minimum(np.searchsorted(cell_labels, values), len(cell_labels) - 1)
+    return np.where(cell_labels[rows] == values, rows, -1).astype(np.int64)
+
+
+def cell_features(volume_path, labels='DNA_masks', channels=None, threshold=CELL_THRESHOLD, progress=no_progress):
+    # (n_cells, n_channels, len(CELL_STATS)) table of the mean, sum and max of every channel over the voxels of
+    # every cell of the label volume and the fraction of them above threshold, one bincount per z-slab and channel;
+    # cells are ordered by label like calculate_centers, stored at cells/features with the labels at cells/labels.
+    # The vertices do not have to come from the same labels, cells/vertex_cell holds the row of the cell each
+    # vertex lies in (-1 if none)
+    vertices = read_dataset(volume_path, 'vertices')
+    vertices = np.zeros((0, 3), dtype=int) if vertices is None else np.asarray(vertices, dtype=int)
+    vertex_values = np.zeros(len(vertices))
+    with read_volume(volume_path) as f:
+        if channels is None:
+            channels = [c for c in f['image'].keys() if c != labels]
+        shape = f['image'][labels].shape
+    depth = max(1, CELL_SLAB_BYTES // (int(np.prod(shape[1:])) * 4))
+    values = cell_labels(volume_path, labels, depth)
+    background = len(values) > 0 and values[0] == 0
+    n = len(values)
+
+    counts = np.zeros(n)
+    sums = np.zeros((len(channels), n))
+    maxima = np.full((len(channels), n), -np.inf)
+    above = np.zeros((len(channels), n))
+    for z in range(0, shape[0], depth):
+        with read_volume(volume_path) as f:
+            label_slab = f['image'][labels][z:z + depth]
+            in_slab = np.all((vertices >= [z, 0, 0]) & (vertices < (z + label_slab.shape[0],) + shape[1:]), axis=1)
+            vertex_values[in_slab] = label_slab[tuple((vertices[in_slab] - [z, 0, 0]).T)]
+            index = np.searchsorted(values, label_slab).ravel()
+            counts += np.bincount(index, minlength=n)
+            for c, channel in enumerate(channels):
+                slab = np.asarray(f['image'][channel][z:z + depth], dtype=np.float64).ravel()
+                sums[c] += np.bincount(index, slab, minlength=n)
+                above[c] += np.bincount(index, slab > threshold, minlength=n)
+                np.maximum.at(maxima[c], index, slab)
+        done = min(z + depth, shape[0])
+        progress(done / shape[0], 'Measured {} of {} slices'.format(done, shape[0]))
+
+    cells = slice(1 if background else 0, n)
+    counts = np.maximum(counts[cells], 1)
+    table = np.stack([sums[:, cells] / counts, sums[:, cells], maxima[:, cells], above[:, cells] / counts], axis=-1)
+    table = np.ascontiguousarray(table.transpose(1, 0, 2), dtype=np.float32)
+
+    with write_volume(volume_path, datasets=['cells']) as f:
+        if 'cells' in f:
+            del f['cells']
+        dataset = f.create_dataset('cells/features', data=table)
+        dataset.attrs['channels'] = np.array(channels, dtype=h5py.string_dtype())
+        dataset.attrs['stats'] = np.array(CELL_STATS, dtype=h5py.string_dtype())
+        dataset.attrs['threshold'] = threshold
+        dataset.attrs['labels'] = labels
+        f.create_dataset('cells/labels', data=values[cells])
+        f.create_dataset('cells/vertex_cell', data=cell_rows(vertex_values, values[cells]))
+    return len(table)
+
+
+def channel_distance_matrices(profiles, max_elements=2 ** 24):
+    # list of (channels, n) edge profiles -> (len(profiles), channels, channels) Wasserstein distances between
+    # the channels of each edge, computed per group of edges with the same profile length
+    n_channels = profiles[0].shape[0] if len(profiles) else 0
+    result = np.zeros((len(profiles), n_channels, n_channels))
+    lengths = np.array([profile.shape[1] for profile in profiles], dtype=int)
+    for n in np.unique(lengths):
+        if n == 0:
+            continue
+        members = np.flatnonzero(lengths == n)
+        step = max(1, max_elements // (n_channels * n_channels * n))
+        for start in range(0, len(members), step):
+            chunk = members[start:start + step]
+            ordered = np.sort(np.stack([profiles[i] for i in chunk]).astype(np.float64), axis=-1)
+            result[chunk] = np.mean(np.abs(ordered[:, :, None, :] - ordered[:, None, :, :]), axis=-1)
+    return result
 
-    with h5py.File(volume_path, 'a') as f:
-        if 'intensities' not in f.keys():
-            f.create_group('intensities')
-        if id not in f['intensities'].keys():
-            f['intensities'].create_group(id)
-        for i in range(len(result)):
-            radius = str(result[i][0])
-            values = result[i][1]
-            if radius not in f['intensities'][id].keys():
-                f['intensities'][id].create_dataset(radius, data=values)
 
-    return
+def colocalization_name(radius, shape):
+    return 'colocalization/{}/{}'.format(shape, radius)
 
 
-def precompute_edge_intensity(volume_path, id, radius, shape):
-    with h5py.File(volume_path, 'r') as f:
-        dims = f['image'][list(f['image'].keys())[0]].shape
-        edge_verteces = f['edges'][int(id) - 1]
-        v1 = f['vertices'][int(edge_verteces[0])]
-        v2 = f['vertices'][int(edge_verteces[1])]
-
-        cVolume = get_shape_coords(v1, v2, radius, dims, shape)
-
-        edge_coords = np.linspace(v1, v2, int(np.linalg.norm(v2 - v1)))
-        tree = KDTree(edge_coords, metric='euclidean')
-
-        voxel_to_edge = np.ones((len(edge_coords), (radius * radius) * 10, 3)) * -1
-
-        for voxel in np.array(np.nonzero(cVolume)).T:
-            i = tree.query(voxel.reshape(1, -1), k=1, return_distance=False)[0][0]
-            j = 0
-            try:
-                while voxel_to_edge[i][j][0] >= 0:
-                    j += 1
-                voxel_to_edge[i][j] = voxel
-            except:
-                print(voxel_to_edge.shape)
-                print(i, j)
-                print(voxel_to_edge[i][j - 1])
-    return radius, voxel_to_edge
-
-
-def precompute_polarizations(volume_path, node_id, radii):
-    r_angles = []
-    c_radii = []
-    with h5py.File(volume_path, 'r') as f:
-        if 'polarization' in f.keys():
-            if str(node_id) in f['polarization'].keys():
-                for radius in radii:
-                    if str(radius) not in f['polarization'][str(node_id)].keys():
-                        c_radii.append(radius)
+COLOCALIZATION_BATCH_SIZE = 4096
+_colocalization_jobs = {}
 
-        cube = f['image'][list(f['image'].keys())[0]][:]
-        center = f['vertices'][node_id][:]
 
-    for radius in c_radii:
-        voxels = get_voxels_within_radius(center, radius, cube.shape)
-        angles = calculate_angles(voxels, center)
-        r_angles.append(angles)
+def precompute_colocalization(volume_path, channels, radius, thresholds, shape, progress=no_progress):
+    # (edges, channels, channels) table of the channel distances of every edge at colocalization/<shape>/<radius>
+    profiles = all_edge_profiles(volume_path, channels, radius, thresholds, shape)
+    progress(0.5, 'Computed {} edge profiles'.format(len(profiles)))
+    matrices = np.zeros((len(profiles), len(channels), len(channels)), dtype=np.float32)
+    for start in range(0, len(profiles), COLOCALIZATION_BATCH_SIZE):
+        batch = range(start, min(start + COLOCALIZATION_BATCH_SIZE, len(profiles)))
+        matrices[start:batch.stop] = channel_distance_matrices([profiles[i] for i in batch])
+        progress(0.5 + 0.5 * batch.stop / len(profiles), 'Compared channels of {} edges'.format(batch.stop))
 
-    with h5py.File(volume_path, 'a') as f:
-        if 'polarization' not in f.keys():
-            f.create_group('polarization')
-            if node_id not in f['polarization'].keys():
-                f.create_group('polarization/' + node_id)
-                for radius, angles in zip(c_radii, r_angles):
-                    if str(radius) not in f['polarization'][node_id].keys():
-                        f['polarization'][node_id].create_dataset(str(radius), data=angles)
+    name = colocalization_name(radius, shape)
+    with write_volume(volume_path, datasets=[name]) as f:
+        if name in f:
+            del f[name]
+        dataset = f.create_dataset(name, data=matrices, chunks=True, maxshape=(None,) + matrices.shape[1:])
+        dataset.attrs['channels'] = np.array(channels, dtype=h5py.string_dtype())
+        dataset.attrs['thresholds'] = np.array(thresholds)
+    return len(matrices)
 
-    return
 
+def submit_colocalization(volume_path, channels, radius, thresholds, shape):
+    # one precompute_colocalization job per table, submitted again only once the previous one has finished
+    key = (volume_path, colocalization_name(radius, shape), tuple(channels), tuple(thresholds))
+    job = job_status(_colocalization_jobs.get(key))
+    if job is None or job['status'] in ['failed', 'done']:
+        _colocalization_jobs[key] = submit('precomputeColocalization', precompute_colocalization, volume_path,
+                                           channels, radius, thresholds, shape)
+    return _colocalization_jobs[key]
 
-def get_edge_channels_rank(volume_path, channels, id, radius, thresholds, shape, save=False):
-    primary_edge = edge_intensities(volume_path, channels, str(id), radius, thresholds, shape, save=save)[id]
 
-    # Calculate pairwise Wasserstein distances
-    channel_names = list(primary_edge.keys())
-    channel_arrays = [primary_edge[name] for name in channel_names]
+def get_colocalization(volume_path, channels, id, radius, thresholds, shape, save=False):
+    # channel x channel distances of edge id, looked up in the (edges, channels, channels) table of the graph;
+    # while the table does not cover the channels it is built in a job and the edge is computed on its own
+    channels = list(channels.split(','))
+    thresholds = [float(t) for t in thresholds.split(',')]
+    name = colocalization_name(radius, shape)
+    index = int(id) - 1
+    with read_volume(volume_path) as f:
+        stored = None
+        if name in f:
+            stored_keys = list(zip([str(c) for c in f[name].attrs['channels']],
+                                   [float(t) for t in f[name].attrs['thresholds']]))
+            if all(key in stored_keys for key in zip(channels, thresholds)):
+                stored = [stored_keys.index(key) for key in zip(channels, thresholds)]
+                row = f[name][index]
+                if not np.any(np.isnan(row)):
+                    return row[np.ix_(stored, stored)].astype(np.float64)
+
+    if stored is not None:
+        # an edge added after the table was computed, fill in its row for all channels of the table
+        stored_channels, stored_thresholds = [key[0] for key in stored_keys], [key[1] for key in stored_keys]
+        profiles = edge_profiles(volume_path, stored_channels, [index], radius, stored_thresholds, shape, save)
+        matrix = channel_distance_matrices([profiles[index]])[0]
+        matrix = matrix.astype(np.float32)
+        with write_volume(volume_path, datasets=[name]) as f:
+            f[name][index] = matrix
+        return matrix[np.ix_(stored, stored)].astype(np.float64)
+
+    submit_colocalization(volume_path, channels, radius, thresholds, shape)
+    profiles = edge_profiles(volume_path, channels, [index], radius, thresholds, shape, save)
+    # rounded like the table so results do not change once it exists
+    return channel_distance_matrices([profiles[index]])[0].astype(np.float32).astype(np.float64)
 
-    dist_matrix = np.zeros((len(channel_arrays), len(channel_arrays)))
-    for i in range(len(channel_arrays)):
-        for j in range(i + 1, len(channel_arrays)):
-            dist_matrix[i, j] = wasserstein_distance(channel_arrays[i], channel_arrays[j])
-            dist_matrix[j, i] = dist_matrix[i, j]
+
+def get_edge_channels_rank(volume_path, channels, id, radius, thresholds, shape, save=False):
+    dist_matrix = get_colocalization(volume_path, channels, id, radius, thresholds, shape, save=save)
+    channel_names = [f'{channel} ' for channel in channels.split(',')]
 
     # Convert the distance matrix to a condensed distance matrix (1D)
-    condensed_dist_matrix = squareform(dist_matrix)
+    condensed_dist_matrix = squareform(dist_matrix, checks=False)
 
     # Apply hierarchical clustering
     Z = linkage(condensed_dist_matrix, method="average")
@@ -450,18 +897,8 @@ def get_edge_channels_rank(volume_path, channels, id, radius, thresholds, shape,
 
 
 def get_edge_channels_clusters(volume_path, channels, id, radius, thresholds, shape, cluster_threshold, save=False):
-    primary_edge = edge_intensities(volume_path, channels, str(id), radius, thresholds, shape, save=save)[id]
-
-    # Extract channel names and their respective intensity arrays
-    channel_names = list(primary_edge.keys())
-    channel_arrays = [primary_edge[name] for name in channel_names]
-
-    # Calculate pairwise Wasserstein distances
-    dist_matrix = np.zeros((len(channel_arrays), len(channel_arrays)))
-    for i in range(len(channel_arrays)):
-        for j in range(i + 1, len(channel_arrays)):
-            dist_matrix[i, j] = wasserstein_distance(channel_arrays[i], channel_arrays[j])
-            dist_matrix[j, i] = dist_matrix[i, j]
+    dist_matrix = get_colocalization(volume_path, channels, id, radius, thresholds, shape, save=save)
+    channel_names = [f'{channel} ' for channel in channels.split(',')]
 
     # DBSCAN requires a 1D array of distances, but it uses Euclidean distances by default.
     # Instead, we precompute a distance matrix and then use DBSCAN with a precomputed metric.
@@ -480,4 +917,3 @@ def get_edge_channels_clusters(volume_path, channels, id, radius, thresholds, sh
         clusters[str(label)] = [channel_names[i] for i, lab in enumerate(labels) if lab == label]
 
     return clusters
-
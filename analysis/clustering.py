@@ -1,36 +1,129 @@
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import scipy.sparse as sp
 from sklearn.cluster import DBSCAN
 from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import KDTree, sort_graph_by_row_values
 import h5py
-import matplotlib.pyplot as plt
-from tqdm import tqdm
-from hdbscan import HDBSCAN
+
+# bytes of the cube read at once by prepare_cube
+SLAB_MAX_BYTES = 2 ** 28
+# points per z-slab queried at once when building the neighbor graph
+GRAPH_SLAB_POINTS = 2 ** 16
+
+def _slab_coords(slab, z_offset=0, threshold=0, bin_size=1):
+    # (N, 4) float32 [z, y, x, intensity] of the voxels >= threshold, with bin_size > 1 one row per occupied
+    # bin_size^3 cell holding the mean position and intensity of its voxels; also returns the voxel count per row
+    z, y, x = np.nonzero(slab >= threshold)
+    values = slab[z, y, x]
+    if bin_size == 1:
+        coords = np.empty((len(z), 4), dtype=np.float32)
+        coords[:, 0] = z + z_offset
+        coords[:, 1] = y
+        coords[:, 2] = x
+        coords[:, 3] = values
+        return coords, np.ones(len(z), dtype=np.int64)
+
+    bins = tuple(-(-s // bin_size) for s in slab.shape)
+    keys = np.ravel_multi_index((z // bin_size, y // bin_size, x // bin_size), bins)
+    keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    coords = np.empty((len(keys), 4), dtype=np.float32)
+    coords[:, 0] = np.bincount(inverse, z, len(keys)) / counts + z_offset
+    coords[:, 1] = np.bincount(inverse, y, len(keys)) / counts
+    coords[:, 2] = np.bincount(inverse, x, len(keys)) / counts
+    coords[:, 3] = np.bincount(inverse, values, len(keys)) / counts
+    return coords, counts
 
 def cube_2_coords(cube, threshold=0):
-    coords = []
-    np_coords = np.where(cube >= threshold)
-    for z,y,x in tqdm(zip(*np_coords), total=len(np_coords[0])):
-        coords.append([z, y, x, cube[z, y, x]])
-    return np.array(coords, dtype=np.float32)
-
-def prepare_cube(cube, threshold=0):
-    coords = cube_2_coords(cube, threshold)
+    return _slab_coords(np.asarray(cube), 0, threshold)[0]
+
+def iter_slabs(cube, max_bytes=SLAB_MAX_BYTES, multiple=1):
+    # (z, slab) over a numpy array or h5py dataset, slabs are a multiple of multiple planes deep
+    plane_bytes = int(np.prod(cube.shape[1:])) * cube.dtype.itemsize
+    depth = max(multiple, max_bytes // plane_bytes // multiple * multiple)
+    for z in range(0, cube.shape[0], depth):
+        yield z, np.asarray(cube[z:z + depth])
+
+def prepare_cube(cube, threshold=0, bin_size=1, fraction=None, max_points=None, max_bytes=SLAB_MAX_BYTES,
+                 seed=0, return_weights=False):
+    # marker coordinates of a numpy cube or h5py dataset, read one z-slab at a time so only the slab and the
+    # (binned, subsampled) points are held in memory. fraction keeps a random share of the points of every slab,
+    # max_points caps the total; weights are the number of voxels behind every point
+    rng = np.random.default_rng(seed)
+    coords, weights = [], []
+    for z, slab in iter_slabs(cube, max_bytes, bin_size):
+        c, w = _slab_coords(slab, z, threshold, bin_size)
+        if fraction is not None:
+            keep = rng.random(len(c)) < fraction
+            c, w = c[keep], w[keep]
+        coords.append(c)
+        weights.append(w)
+    coords = np.concatenate(coords) if coords else np.zeros((0, 4), dtype=np.float32)
+    weights = np.concatenate(weights) if weights else np.zeros(0, dtype=np.int64)
+    if max_points is not None and len(coords) > max_points:
+        keep = np.sort(rng.choice(len(coords), max_points, replace=False))
+        coords, weights = coords[keep], weights[keep]
+    if return_weights:
+        return coords, weights
     return coords
 
 def generate_pairwise_distances(X, metric="euclidean"):
     return pairwise_distances(X, metric=metric)
 
 
-def dbscan_markers(X, eps, min_samples, n_jobs=1, gpu=False, metric="euclidean"):
-    from sklearnex import patch_sklearn, config_context
-    patch_sklearn()
+def radius_neighbors_graph(X, eps, n_jobs=1, slab_points=GRAPH_SLAB_POINTS):
+    # sparse (N, N) CSR matrix of the euclidean distances between points closer than eps, self loops included
+    # as explicit zeros. Points are queried against one KD-tree in z-slabs of slab_points, in parallel
+    X = np.asarray(X, dtype=np.float64)
+    tree = KDTree(X)
+    order = np.argsort(X[:, 0], kind='stable')
+    slabs = [order[i:i + slab_points] for i in range(0, len(X), slab_points)]
+
+    def query(rows):
+        indices, distances = tree.query_radius(X[rows], eps, return_distance=True)
+        lengths = np.array([len(i) for i in indices], dtype=np.int64)
+        if len(rows) == 0 or lengths.sum() == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        return np.repeat(rows, lengths), np.concatenate(indices), np.concatenate(distances)
+
+    n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 0 else n_jobs
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+        parts = list(executor.map(query, slabs))
+    rows = np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate([p[1] for p in parts]) if parts else np.zeros(0, dtype=np.int64)
+    data = np.concatenate([p[2] for p in parts]) if parts else np.zeros(0)
+    graph = sp.csr_matrix((data, (rows, cols)), shape=(len(X), len(X)))
+    return sort_graph_by_row_values(graph, warn_when_not_sorted=False)
+
+
+def dbscan_markers(X, eps, min_samples, n_jobs=1, gpu=False, metric="euclidean", sample_weight=None, sparse=False):
+    # sparse=True clusters on a radius neighbors graph of X instead of letting DBSCAN search neighborhoods,
+    # memory grows with the number of neighbor pairs rather than N^2 (only for metric="euclidean")
+    if sparse:
+        graph = radius_neighbors_graph(X, eps, n_jobs)
+        db = DBSCAN(eps=eps, min_samples=min_samples, metric="precomputed")
+        db.fit(graph, sample_weight=sample_weight)
+        return db.labels_
+
     if gpu:
+        from sklearnex import config_context
+        from sklearnex.cluster import DBSCAN as DBSCANEx
         with config_context(target_offload="gpu:0"):
-            db = DBSCAN(eps=eps, min_samples=min_samples, metric=metric)
-            db.fit(X)
-    else:
-        db = DBSCAN(eps=eps, min_samples=min_samples, n_jobs=n_jobs, metric=metric)
-        db.fit(X)
+            db = DBSCANEx(eps=eps, min_samples=min_samples, metric=metric)
+            db.fit(X, sample_weight=sample_weight)
+        return db.labels_
+
+    try:
+        from sklearnex.cluster import DBSCAN as DBSCANEx
+    except ImportError:
+        DBSCANEx = DBSCAN
+    db = DBSCANEx(eps=eps, min_samples=min_samples, n_jobs=n_jobs, metric=metric)
+    db.fit(X, sample_weight=sample_weight)
     labels = db.labels_
     return labels
 
@@ -41,9 +134,36 @@ def hdbscan_markers(X, min_cluster_size, gpu=False, metric="euclidean"):
         db = HDBSCAN(min_cluster_size=min_cluster_size, metric=metric)
         db.fit(X)
     else:
-        from hdbscan import HDBSCAN
+        try:
+            from hdbscan import HDBSCAN
+        except ImportError:
+            from sklearn.cluster import HDBSCAN
 
         db = HDBSCAN(min_cluster_size=min_cluster_size, metric=metric)
         db.fit(X)
     labels = db.labels_
-    return labels
\ No newline at end of file
+    return labels
+
+
+if __name__ == '__main__':
+    # python clustering.py [max_points]: DBSCAN on a dense distance matrix vs. the sparse neighbor graph
+    # for random marker clouds of 10^3 up to max_points (default 10^6) points, with peak traced memory
+    max_points = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6
+    rng = np.random.default_rng(0)
+    n = 1000
+    while n <= max_points:
+        side = int(round(n ** (1 / 3))) * 2
+        X = np.concatenate([rng.random((n, 3)) * side, rng.random((n, 1))], axis=1).astype(np.float32)
+        runs = [('sparse', lambda: dbscan_markers(X, 1.5, 10, n_jobs=-1, sparse=True))]
+        if n <= 20000:
+            runs.append(('dense', lambda: dbscan_markers(generate_pairwise_distances(X), 1.5, 10, metric="precomputed")))
+        for name, run in runs:
+            tracemalloc.start()
+            start = time.perf_counter()
+            labels = run()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("{:>8} points {:>6}: {:>6} clusters in {:.2f}s, peak {:.1f} MB ({:.0f} B/point)".format(
+                n, name, len(np.unique(labels[labels >= 0])), elapsed, peak / 2 ** 20, peak / n))
+        n *= 10
@@ -2,17 +2,21 @@ from turtle import distance
 import numpy as np
 import h5py
 import tifffile
-import scipy.spatial as sptl
-import scipy.sparse as sprs
 from skimage.measure import regionprops
 from skimage.draw import line_nd
 from skimage.morphology import ball, diamond
 import skimage.filters
 from tqdm import tqdm
 import nrrd
+import os
 import sys
 from sklearn.neighbors import KDTree
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from graph import get_delaunay_edges, get_gabriel_graph
+from ingest import ingest_tiff
+from analysis import cell_features
+
 marker_names = ["DNA1","PD1","TLR3","SOX10","DNA2","CD163",
 "CD3D","PDL1","DNA3","CD4","ICOS","HLADPB1","DNA4","CD8A",
 "CD68","GZMB","DNA5","CD40L","LAG3","HLAA","DNA6","SQSTM",
@@ -40,16 +44,7 @@ def merge_close_regions(channel, min_dist):
 
 def generate_cube(filename):
     print("Generating cube")
-    img = tifffile.imread(filename)
-    img = np.moveaxis(img, 0, 1)
-    with h5py.File("data/cube.h5", "w") as cube:
-        for i, c in tqdm(enumerate(marker_names), total=len(marker_names)):
-            new_img = np.array(img[i], dtype=np.float32)
-            new_img /= np.max(new_img)
-            if c not in ["DNA_masks", "HLAA_masks", "DNA_binary_masks", "HLAA_binary_masks"]:
-                pass
-                #new_img = skimage.filters.gaussian(new_img)
-            cube.create_dataset('image/{}'.format(c), data=new_img)
+    ingest_tiff(filename, "data/cube.h5", channel_names=marker_names, create_graph=False)
 
 def load_channel(channel_name=None):
     with h5py.File("data/cube.h5", "r") as cubef:
@@ -73,39 +68,6 @@ def get_nuclei_centers(channel, alter=False):
     centers = [region.centroid for region in regions]
     return np.array(centers, dtype=int)
 
-def get_delaunay_edges(points):
-    tri = sptl.Delaunay(points)
-    lil = sprs.lil_matrix((tri.npoints, tri.npoints))
-
-    indices, indptr = tri.vertex_neighbor_vertices
-    for k in range(tri.npoints):
-        lil.rows[k] = indptr[indices[k]:indices[k+1]].tolist()
-        lil.data[k] = np.ones_like(lil.rows[k]).tolist()
-
-    coo = lil.tocoo()
-    conns = np.vstack((coo.row, coo.col)).T
-    delaunay_conns = np.sort(conns, axis=1)
-    return delaunay_conns, tri
-
-def get_gabriel_graph(tri, delaunay_conns, min_dist=10):
-    c = tri.points[delaunay_conns]
-    m = (c[:, 0, :] + c[:, 1, :])/2
-    r = np.sqrt(np.sum((c[:, 0, :] - c[:, 1, :])**2, axis=1))/2
-    tree = sptl.KDTree(points)
-    n = tree.query(x=m, k=1)[0]
-    g = n >= r*(0.999)
-    gabriel_conns = delaunay_conns[g]
-    edges = []
-    for edge in gabriel_conns:
-        found = False
-        for controll in edges:
-            if controll[0] == edge[0] and controll[1] == edge[1]:
-                found = True
-                break
-        if not found:
-            edges.append(edge)
-    return np.array(edges)
-
 def generate_visual_edges(gabriel_conns, shape, radius):
     print("Generating cones from edges")
     visual_graph = np.zeros(shape, dtype=np.uint16)
@@ -201,6 +163,7 @@ points = get_nuclei_centers(dna_masks, alter=True)
 delaunay_conns, tri = get_delaunay_edges(points)
 gabriel_conns = get_gabriel_graph(tri, delaunay_conns)
 save_graph(points, gabriel_conns, edge_radius, "data/cube.h5")
+cell_features("data/cube.h5", "DNA_masks", threshold=threshold)
 #generate_nrrds(marker_names)
 #edge_channel = generate_visual_edges(gabriel_conns, dna_masks.shape, edge_radius)
 #meassure_markers(marker_names, edge_channel, points, gabriel_conns, threshold, step_size=1)
@@ -1,4 +1,4 @@
-from clustering import dbscan_markers, hdbscan_markers, prepare_cube, generate_pairwise_distances
+from clustering import dbscan_markers, hdbscan_markers, iter_slabs, prepare_cube, generate_pairwise_distances
 import h5py
 import numpy as np
 #from segmentation import cellpose_segmentation, generate_cube
@@ -7,16 +7,23 @@ def main():
     #generate_cube("data/1_01_R3D_D3D_3D_MERGED.tif", [30,70])
     #cellpose_segmentation("data/1_01_R3D_D3D_3D_MERGED.tif", "DNA_masks", [19], [30,70], "nuclei", do_3D=True)
     #cellpose_segmentation("data/1_01_R3D_D3D_3D_MERGED.tif", "HLAA_masks", [19,21], [30,70], "cyto2", do_3D=False)
-    cube = load_cube("PD1")
-    coords = prepare_cube(cube)
-    print("Calculating Distance Matrix")
-    #distance_matrix = generate_pairwise_distances(coords)
+    coords = load_coords("PD1")
     print("Clustering")
-    #labels = dbscan_markers(distance_matrix, 1.0, 100, 1, False)
+    #labels = dbscan_markers(coords, 1.0, 100, -1, sparse=True)
     labels = hdbscan_markers(coords, 500, gpu=False, metric="euclidean")
     print(np.unique(labels))
 
 
+def load_coords(channel, threshold=0, bin_size=1, max_points=None):
+    # streams the channel from disk, intensities normalized by the channel maximum like load_cube
+    with h5py.File("data/cube.h5", "r") as f:
+        cube = f[channel]
+        cube_max = max(slab.max() for z, slab in iter_slabs(cube))
+        coords = prepare_cube(cube, threshold * cube_max, bin_size=bin_size, max_points=max_points)
+    coords[:, 3] /= cube_max
+    return coords
+
+
 def load_cube(channel):
     with h5py.File("data/cube.h5", "r") as f:
         cube = np.array(f[channel])
@@ -3,17 +3,20 @@ import os
 from flask import Flask, jsonify, request, session, render_template, Response, send_file
 import h5py
 import numpy as np
-import tifffile
 from sklearn.neighbors import KDTree
 from tqdm import trange
 from skimage.io import imsave
 from PIL import Image
-import base64
 from skimage.color import gray2rgb
 from skimage.morphology import disk
 import multiprocessing as mp
 
-from analysis import all_edge_intensities, calculate_centers, edge_intensities, get_delaunay_edges, get_edge_channels_rank, get_gabriel_graph, get_polarizations, get_edge_intensities_rank, precompute_edge_intensities, precompute_polarizations, get_edge_channels_clusters
+from cache import cached_result, channel_cache_stats, clear_results, get_spatial_index, open_dataset, read_dataset, read_volume, result_cache_stats, volume_etag, write_volume
+from graph import edges_in_box, edges_near, resolve_vertices, vertices_in_box, vertices_near
+from ingest import ingest_tiff
+from jobs import job_status, list_jobs, submit
+from volume import COMPRESSIONS, build_pyramid, get_compressor, get_level_dataset, iter_downsampled, iter_volume_bytes, read_region, resolve_channel, to_uint8
+from analysis import all_edge_intensities, calculate_centers, cell_features, CELL_THRESHOLD, edge_intensities, get_edge_channels_rank, get_polarizations, get_edge_intensities_rank, precompute_edge_intensities, precompute_polarizations, POLARIZATION_MODES, POLARIZATION_THRESHOLDS, get_edge_channels_clusters, update_graph
 
 app = Flask(__name__)
 app.config.update(
@@ -23,6 +26,11 @@ app.config.update(
     SECRET_KEY=os.urandom(12),
 )
 
+ingest_jobs = {}
+# max distance in voxels between a center to delete and the vertex it refers to
+DELETE_TOLERANCE = 2.0
+GRAPH_FORMATS = ['json', 'columnar', 'binary']
+
 @app.route("/", methods=['GET'])
 def index():
     return render_template('index.html'), 200
@@ -35,16 +43,13 @@ def viewer():
         return 'Invalid volume path', 400
     
     if not volume_path.endswith('.h5'):
-        img = tifffile.imread(volume_path)
-        img = np.moveaxis(img, 0, 1)
         h5_path = volume_path.split('.')[0] + '.h5'
-        with h5py.File(h5_path, "w") as cube:
-            for i in range(img.shape[0]):
-                new_img = np.array(img[i], dtype=np.float32)
-                new_img /= np.max(new_img)
-                cube.create_dataset('image/{}'.format(i), data=new_img)
-            cube.create_dataset('edges', chunks=True, maxshape=(None, 2))
-            cube.create_dataset('vertices', chunks=True, maxshape=(None, 3))
+        if not os.path.exists(h5_path) or os.path.getmtime(h5_path) < os.path.getmtime(volume_path):
+            # convert in the background, the index page polls the job and resubmits once it is done
+            job = job_status(ingest_jobs.get(volume_path))
+            if job is None or job['status'] in ['failed', 'done']:
+                ingest_jobs[volume_path] = submit('ingest', ingest_tiff, volume_path, h5_path)
+            return render_template('index.html', job_id=ingest_jobs[volume_path], volume_path=volume_path), 202
         session['volumePath'] = h5_path
     else:
         session['volumePath'] = request.form['volumePath']
@@ -62,45 +67,184 @@ def viewer():
     '''
     return render_template('viewer.html'), 200
 
+def not_modified(tag):
+    if request.if_none_match.contains(tag):
+        response = Response(status=304, headers={'Cache-Control': 'no-cache'})
+        response.set_etag(tag)
+        return response
+    return None
+
+def graph_response(columns, graph_format, tag):
+    # columns: name -> int array, one entry per vertex / edge
+    if graph_format == 'binary':
+        names = list(columns.keys())
+        data = np.stack([columns[name] for name in names]).astype('<i4') if names else np.zeros(0, dtype='<i4')
+        count = len(columns[names[0]]) if names else 0
+        response = Response(data.tobytes(), mimetype='application/octet-stream',
+                            headers={'X-Graph-Count': str(count), 'X-Graph-Columns': ','.join(names),
+                                     'Access-Control-Expose-Headers': 'X-Graph-Count, X-Graph-Columns, ETag'})
+    else:
+        response = jsonify({name: column.tolist() for name, column in columns.items()})
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(tag)
+    return response
+
+def volume_offset(volume_path):
+    # vertices are sent centered on the volume, (z, y, x) order
+    with read_volume(volume_path) as f:
+        dims = f['image'][list(f['image'].keys())[0]].shape
+    return np.array(dims) * 0.5
+
+def vertex_columns(volume_path):
+    offset = volume_offset(volume_path)
+    vertices = read_dataset(volume_path, 'vertices')
+    if vertices is None:
+        vertices = np.zeros((0, 3), dtype=int)
+    cell_types = np.zeros(len(vertices), dtype=int)
+    stored_types = read_dataset(volume_path, 'cell_types')
+    if stored_types is not None:
+        n = min(len(stored_types), len(vertices))
+        cell_types[:n] = stored_types[:n]
+    return {'x': (vertices[:, 2] - offset[2]).astype(int), 'y': (vertices[:, 1] - offset[1]).astype(int),
+            'z': (vertices[:, 0] - offset[0]).astype(int), 'cellType': cell_types}
+
+def edge_columns(volume_path):
+    edges = read_dataset(volume_path, 'edges')
+    if edges is None:
+        edges = np.zeros((0, 2), dtype=int)
+    return {'start': edges[:, 0].astype(int), 'end': edges[:, 1].astype(int)}
+
+def vertices_json(columns, ids):
+    return [{'x': x, 'y': y, 'z': z, 'id': str(i), 'cellType': cell_type} for i, x, y, z, cell_type in
+            zip(ids.tolist(), *[columns[name].tolist() for name in ['x', 'y', 'z', 'cellType']])]
+
+def edges_json(columns, ids):
+    return [{'start': start, 'end': end, 'id': str(i)} for i, start, end in
+            zip(ids.tolist(), columns['start'].tolist(), columns['end'].tolist())]
+
 @app.route("/vertices", methods=['GET'])
 def get_vertices():
-    result = []
-    with h5py.File( session['volumePath'], 'r') as f:
-        dims = f['image'][list(f['image'].keys())[0]].shape
-    with h5py.File( session['volumePath'], 'r') as f:
-        if not 'vertices' in f.keys():
-            return jsonify(result)
-        for i, vertex in enumerate(f['vertices']):
-            cell_type = 0
-            if 'cell_types' in f.keys():
-                if len(f['cell_types']) > i:
-                    cell_type = int(f['cell_types'][i])
-            j_vertex = {'x': int(vertex[2]-dims[2]*0.5), 'y': int(vertex[1]-dims[1]*0.5), 'z': int(vertex[0]-dims[0]*0.5), 'id': str(i), 'cellType': cell_type}
-            result.append(j_vertex)
-    return jsonify(result), 200
+    graph_format = request.args.get('format', 'json')
+    if graph_format not in GRAPH_FORMATS:
+        return "Invalid format", 400
+    volume_path = session['volumePath']
+    tag = volume_etag(volume_path, 'vertices', graph_format)
+    cached = not_modified(tag)
+    if cached is not None:
+        return cached
+
+    columns = vertex_columns(volume_path)
+    if graph_format != 'json':
+        return graph_response(columns, graph_format, tag)
+    response = jsonify(vertices_json(columns, np.arange(len(columns['x']))))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(tag)
+    return response, 200
 
 @app.route("/edges", methods=['GET'])
 def get_edges():
-    result = []
-    with h5py.File(session['volumePath'], 'r') as f:
-        if not 'edges' in f.keys():
-            return jsonify(result)
-        for i, edge in enumerate(f['edges']):
-            j_edge = {'start': int(edge[0]), 'end': int(edge[1]), 'id': str(i+1)}
-            result.append(j_edge)
-    return jsonify(result), 200
+    graph_format = request.args.get('format', 'json')
+    if graph_format not in GRAPH_FORMATS:
+        return "Invalid format", 400
+    volume_path = session['volumePath']
+    tag = volume_etag(volume_path, 'edges', graph_format)
+    cached = not_modified(tag)
+    if cached is not None:
+        return cached
+
+    columns = edge_columns(volume_path)
+    if graph_format != 'json':
+        return graph_response(columns, graph_format, tag)
+    response = jsonify(edges_json(columns, np.arange(len(columns['start'])) + 1))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(tag)
+    return response, 200
+
+def parse_region(offset):
+    # ?min=x,y,z&max=x,y,z or ?center=x,y,z&radius=r in centered viewer coordinates,
+    # returned as ('box', lo, hi) or ('sphere', center, radius) in (z, y, x) volume coordinates
+    def point(name):
+        return np.array([float(c) for c in request.args[name].split(',')])[::-1] + offset
+    if 'min' in request.args and 'max' in request.args:
+        return 'box', point('min'), point('max')
+    if 'center' in request.args and 'radius' in request.args:
+        return 'sphere', point('center'), float(request.args['radius'])
+    return None
+
+@app.route("/vertices/region", methods=['GET'])
+def get_vertices_region():
+    graph_format = request.args.get('format', 'json')
+    if graph_format not in GRAPH_FORMATS:
+        return "Invalid format", 400
+    volume_path = session['volumePath']
+    region = parse_region(volume_offset(volume_path))
+    if region is None:
+        return "Expected min and max or center and radius", 400
+    tag = volume_etag(volume_path, request.full_path)
+    cached = not_modified(tag)
+    if cached is not None:
+        return cached
+
+    index = get_spatial_index(volume_path)
+    if region[0] == 'box':
+        ids = vertices_in_box(index, region[1], region[2])
+    else:
+        ids = vertices_near(index, region[1], region[2])
+    columns = {name: column[ids] for name, column in vertex_columns(volume_path).items()}
+    if graph_format != 'json':
+        return graph_response(dict(id=ids, **columns), graph_format, tag)
+    response = jsonify(vertices_json(columns, ids))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(tag)
+    return response, 200
+
+@app.route("/edges/region", methods=['GET'])
+def get_edges_region():
+    graph_format = request.args.get('format', 'json')
+    if graph_format not in GRAPH_FORMATS:
+        return "Invalid format", 400
+    volume_path = session['volumePath']
+    region = parse_region(volume_offset(volume_path))
+    if region is None:
+        return "Expected min and max or center and radius", 400
+    tag = volume_etag(volume_path, request.full_path)
+    cached = not_modified(tag)
+    if cached is not None:
+        return cached
+
+    index = get_spatial_index(volume_path)
+    if region[0] == 'box':
+        ids = edges_in_box(index, region[1], region[2])
+    else:
+        ids = edges_near(index, region[1], region[2])
+    columns = {name: column[ids] for name, column in edge_columns(volume_path).items()}
+    if graph_format != 'json':
+        return graph_response(dict(id=ids + 1, **columns), graph_format, tag)
+    response = jsonify(edges_json(columns, ids + 1))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(tag)
+    return response, 200
 
 @app.route("/marker/<name>", methods=['GET'])
 def marker(name):
     name = name.strip()
+    level = request.args.get('level', None)
     result = None
-    with h5py.File(session['volumePath'], 'r') as f:
-        if name not in f.keys():
+    with read_volume(session['volumePath']) as f:
+        # levels precomputed by build_pyramid exist for the channels under image/
+        stored = None
+        if level is not None and 'image' in f.keys() and name in f['image'].keys():
+            stored = get_level_dataset(f, name, int(level))
+        if stored is None and name not in f.keys():
             return "Marker not found!", 404
-        marker = f[name]
         
-        marker = np.array(marker, dtype=np.float32)
-        marker = marker[28:30, 500:, 500:]
+        if level is None:
+            marker = np.array(f[name], dtype=np.float32)
+            marker = marker[28:30, 500:, 500:]
+        elif stored is not None:
+            marker = np.asarray(stored, dtype=np.float32)
+        else:
+            marker = np.concatenate(list(iter_downsampled(f[name], 2 ** int(level))))
         result = {'xLength':marker.shape[0], 'yLength':marker.shape[1], 'zLength':marker.shape[2]}
         marker /= np.max(marker)
         marker = np.reshape(marker, -1)
@@ -110,12 +254,16 @@ def marker(name):
 @app.route("/channels", methods=['GET'])
 def get_channel_names():
     results = {}
-    with h5py.File(session['volumePath'], 'r') as f:
+    with read_volume(session['volumePath']) as f:
         for key in f['image'].keys():
             key = '{} '.format(key)
             results[key] = key
     return jsonify(results), 200
 
+def float_list(value):
+    # '0.1, 0.20' and '0.1,0.2' are the same request
+    return [float(v) for v in value.split(',')] if value else None
+
 @app.route("/intensity", methods=['GET'])
 def get_edge_intensities():
     id  = request.args.get('id', None)
@@ -133,7 +281,9 @@ def get_edge_intensities():
     session['thresholds'] = thresholds
     session['shape'] = shape
 
-    result = edge_intensities(session['volumePath'], channels, id, radius, thresholds, shape, save=False)
+    result = cached_result(session['volumePath'], 'intensity',
+                           [id, radius, channels.split(','), float_list(thresholds), shape],
+                           lambda: edge_intensities(session['volumePath'], channels, id, radius, thresholds, shape, save=False))
     
     return jsonify(result), 200
 
@@ -151,7 +301,9 @@ def prepare_all_edge_intensities():
     session['thresholds'] = thresholds
     session['shape'] = shape
 
-    result = all_edge_intensities(session['volumePath'], channels, radius, thresholds, shape, save=False)
+    result = cached_result(session['volumePath'], 'intensity/all',
+                           [radius, channels.split(','), float_list(thresholds), shape],
+                           lambda: all_edge_intensities(session['volumePath'], channels, radius, thresholds, shape, save=False))
 
     return jsonify(result), 200
 
@@ -184,71 +336,100 @@ def get_edge_intensities_csv():
 def get_volume(name):
     
     name = name.strip()
+    level = int(request.args.get('level', 0))
     result = {}
-    with h5py.File(session['volumePath'], 'r') as f:
-        if name == 'first':
-            volume = f['image'][list(f['image'].keys())[0]]
-        elif name not in f['image'].keys():
+    with read_volume(session['volumePath']) as f:
+        channel = resolve_channel(f, name)
+        if channel is None:
             return "Volume not found!", 404
-        else:
-            volume = f['image'][name]
-        volume = np.array(volume, dtype=np.float32)
+        volume = get_level_dataset(f, channel, level)
+        if volume is None:
+            return "Level not found!", 404
+        volume = to_uint8(volume[()])
         result = {'xLength':volume.shape[2], 'yLength':volume.shape[1], 'zLength':volume.shape[0]}
-        volume *= 255
-        volume = np.reshape(volume, -1)
-        volume = np.array(volume, dtype=np.uint8)
-        result['data'] = volume.tolist()
+        result['data'] = np.reshape(volume, -1).tolist()
 
     return jsonify(result), 200
 
+@app.route("/volume/<name>/raw", methods=['GET'])
+def get_volume_raw(name):
+    compression = request.args.get('compression', None)
+    level = int(request.args.get('level', 0))
+    if compression is not None and compression not in COMPRESSIONS:
+        return "Invalid compression", 400
+    try:
+        get_compressor(compression)
+    except ImportError:
+        return "Compression {} not available".format(compression), 400
+
+    volume_path = session['volumePath']
+    with read_volume(volume_path) as f:
+        channel = resolve_channel(f, name.strip())
+        if channel is None:
+            return "Volume not found!", 404
+        volume = get_level_dataset(f, channel, level)
+        if volume is None:
+            return "Level not found!", 404
+        shape = volume.shape
+        full_shape = f['image'][channel].shape
+
+    headers = {'X-Volume-Shape': ','.join(str(s) for s in shape), 'X-Volume-Dtype': 'uint8',
+               'X-Volume-Level': str(level), 'X-Volume-Full-Shape': ','.join(str(s) for s in full_shape),
+               'Access-Control-Expose-Headers': 'X-Volume-Shape, X-Volume-Dtype, X-Volume-Level, X-Volume-Full-Shape'}
+    if compression is not None:
+        headers['Content-Encoding'] = compression
+    else:
+        headers['Content-Length'] = str(int(np.prod(shape)))
+    return Response(iter_volume_bytes(volume_path, channel, compression, level),
+                    mimetype='application/octet-stream', headers=headers)
+
+SLICE_FORMATS = {'png': 'image/png', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+SLICE_SIZE = 400
+SLICE_MARKER_RADIUS = 10
+
 @app.route("/slice/<dim>", methods=['GET'])
 def getSlice(dim):
     x = int(request.args.get('x', None))
     y = int(request.args.get('y', None))
     z = int(request.args.get('z', None))  
     channel = request.args.get('channel', None)
-    
-    with h5py.File(session['volumePath'], 'r') as f:
-        cube = f['image'][channel]
-        
-            
-        x = cube.shape[1] - x + 250
-        y += 250
-        z = int(z + cube.shape[0]/2)+50
-        
-        cube = np.array(cube, dtype=np.float32)
+    image_format = request.args.get('format', 'png')
+    if dim not in ['xy', 'xz', 'yz']:
+        return "Invalid dimension", 400
+    if image_format not in SLICE_FORMATS:
+        return "Invalid format", 400
+    
+    with read_volume(session['volumePath']) as f:
+        cube = open_dataset(f, 'image/' + channel)
+        depth, height = cube.shape[0], cube.shape[1]
+
+        # the view is centered on (z, x, y) in viewer coordinates, SLICE_SIZE wide in-plane
+        # and as deep as the volume plus a margin of 50 along z
+        row = height - x
+        column = y
+        plane = int(z + depth / 2)
+        half = SLICE_SIZE // 2
+        z_min = int(plane + 50 - (depth + 100) / 2)
+        z_max = int(plane + 50 + (depth + 100) / 2)
 
-        cube = np.pad(cube, ((50,50),(250,250),(250,250)), 'constant')
-        
-        x_min = x - 200
-        x_max = x + 200
-        y_min = y - 200
-        y_max = y + 200
-        z_min = int(z - cube.shape[0]/2)
-        z_max = int(z + cube.shape[0]/2)
-        
         if dim == 'xy':
-            image = cube[z, x_min:x_max, y_min:y_max]
+            image = read_region(cube, [plane, row - half, column - half], [plane + 1, row + half, column + half])[0]
         elif dim == 'xz':
-            image = cube[z_min:z_max, x_min:x_max, y]
+            image = read_region(cube, [z_min - 50, row - half, column], [z_max - 50, row + half, column + 1])[:, :, 0]
         elif dim == 'yz':
-            image = cube[z_min:z_max, x, y_min:y_max]
-            
-        img = image
-        img /= np.max(img)
-        img = np.array(img*255, dtype=np.uint8)
-        
-        img = gray2rgb(img)
-        x, y = np.meshgrid(np.arange(img.shape[1]), np.arange(img.shape[0]))
-        radius = 10
-        distance = np.sqrt((x - img.shape[1]/2) ** 2 + (y - img.shape[0]/2) ** 2)
-        img[distance < radius] = (255, 0, 0)
-        img = Image.fromarray(img.astype("uint8"))
-        rawBytes = BytesIO()
-        img.save(rawBytes, "JPEG")
-        rawBytes.seek(0)
-        img_base64 = base64.b64encode(rawBytes.read())
-        return jsonify({'status':str(img_base64)})
+            image = read_region(cube, [z_min - 50, row, column - half], [z_max - 50, row + 1, column + half])[:, 0, :]
+
+    img = image
+    max = np.max(img) if img.size else 0
+    img = np.array(img / max * 255 if max > 0 else img, dtype=np.uint8)
+    
+    img = gray2rgb(img)
+    yy, xx = np.ogrid[:img.shape[0], :img.shape[1]]
+    img[(xx - img.shape[1] / 2) ** 2 + (yy - img.shape[0] / 2) ** 2 < SLICE_MARKER_RADIUS ** 2] = (255, 0, 0)
+    img = Image.fromarray(img.astype("uint8"))
+    rawBytes = BytesIO()
+    img.save(rawBytes, image_format.upper(), **({'compress_level': 1} if image_format == 'png' else {}))
+    return Response(rawBytes.getvalue(), mimetype=SLICE_FORMATS[image_format])
     
 @app.route("/vertices", methods=['POST'])
 def addNewCenters():
@@ -303,36 +484,33 @@ def addNewCenters():
     return jsonify({'status':'ok'}), 200
     '''
 
+    # body is [newCenters, deleteCenters] or {'insert': [...], 'delete': [...], 'tolerance': t},
+    # all in the centered (z, y, x) coordinates returned by GET /vertices
     request_data = request.get_json()
-    newCenters = request_data[0]
-    deleteCenters = request_data[1]
-    with h5py.File(session['volumePath'], 'a') as f:
+    if isinstance(request_data, dict):
+        newCenters = request_data.get('insert', [])
+        deleteCenters = request_data.get('delete', [])
+        tolerance = float(request_data.get('tolerance', DELETE_TOLERANCE))
+    else:
+        newCenters = request_data[0]
+        deleteCenters = request_data[1]
+        tolerance = DELETE_TOLERANCE
+    with read_volume(session['volumePath']) as f:
         dims = f['image'][list(f['image'].keys())[0]].shape
-        vertices_ds = f['vertices'][:]
-        for i in newCenters:
-            x = int(i[2]+dims[2]*0.5)
-            y = int(i[1]+dims[1]*0.5)
-            z = int(i[0]+dims[0]*2)
-            vertices_ds = np.vstack((vertices_ds, np.array([z, y, x])))
-        
-        for dc in deleteCenters:
-            x = int(dc[2]+dims[2]*0.5)
-            y = int(dc[1]+dims[1]*0.5)
-            z = int(dc[0]+dims[0]*0.5)
-            for i, oc in enumerate(vertices_ds):
-                if oc[0] == z or oc[1] == y or oc[2] == x:
-                    vertices_ds = np.delete(vertices_ds, i, 0)
-                    break
+    offset = np.array(dims) * 0.5
+    vertices_ds = read_dataset(session['volumePath'], 'vertices')
 
-        delaunay_conns, tri = get_delaunay_edges(vertices_ds)
-        gabriel_conns = get_gabriel_graph(tri, delaunay_conns, vertices_ds)
-        del f['vertices']
-        del f['edges']
-        del f['intensities']
-        f.create_dataset("vertices", data=vertices_ds)
-        f.create_dataset("edges", data=gabriel_conns)
-        f.create_group("intensities")
-    return jsonify({'status':'ok'}), 200
+    inserted = (np.array(newCenters, dtype=float).reshape(-1, 3) + offset).astype(int)
+    deleted = resolve_vertices(vertices_ds, np.array(deleteCenters, dtype=float).reshape(-1, 3) + offset, tolerance)
+
+    vertex_remap, edge_remap = update_graph(session['volumePath'], inserted, deleted[deleted >= 0])
+    clear_results(session['volumePath'])
+    kept = int(np.count_nonzero(vertex_remap >= 0))
+    return jsonify({'status':'ok',
+                    'vertices': vertex_remap.tolist(),
+                    'edges': np.where(edge_remap >= 0, edge_remap + 1, -1).tolist(),
+                    'inserted': list(range(kept, kept + len(inserted))),
+                    'unmatched': [deleteCenters[i] for i in np.flatnonzero(deleted < 0)]}), 200
 
 @app.route("/polarization", methods=['GET'])
 def get_polarization_for_id():
@@ -340,11 +518,17 @@ def get_polarization_for_id():
     channel = request.args.get('channel', None)
     threshold = float(request.args.get('threshold', None))
     edge_ids = request.args.get('edge_ids', None)
+    mode = request.args.get('mode', '2d')
     
+    if mode not in POLARIZATION_MODES:
+        return "Invalid mode", 400
+    if radius < 1:
+        return "Radius must be at least 1", 400
     channel = channel.strip()
     edge_ids = [int(id) for id in edge_ids.split(',')]
     
-    arcs = get_polarizations(session['volumePath'],edge_ids, channel, radius, threshold)
+    arcs = cached_result(session['volumePath'], 'polarization', [edge_ids, channel, radius, threshold, mode],
+                         lambda: get_polarizations(session['volumePath'],edge_ids, channel, radius, threshold, mode))
     return jsonify(arcs), 200
 
 @app.route("/intensities/rank", methods=['GET'])
@@ -355,8 +539,10 @@ def get_intensities_rank():
     thresholds = request.args.get('thresholds', None)
     shape = request.args.get('shape', None)
     edges = request.args.get('edges', None)
+    k = request.args.get('k', None)
     
     channels = channels.replace(' ', '')
+    k = int(k) if k is not None else None
 
     session['id'] = id
     session['radius'] = radius
@@ -364,7 +550,10 @@ def get_intensities_rank():
     session['thresholds'] = thresholds
     session['shape'] = shape
     
-    result = get_edge_intensities_rank(session['volumePath'], channels, id, radius, thresholds, shape, save=False, edges=edges)
+    result = cached_result(session['volumePath'], 'intensities/rank',
+                           [id, radius, channels.split(','), float_list(thresholds), shape,
+                            [int(i) for i in edges.split(',')] if edges else None, k],
+                           lambda: get_edge_intensities_rank(session['volumePath'], channels, id, radius, thresholds, shape, save=False, edges=edges, k=k))
     
     return jsonify(result), 200
     
@@ -384,7 +573,9 @@ def get_channels_rank():
     session['thresholds'] = thresholds
     session['shape'] = shape
     
-    result = get_edge_channels_rank(session['volumePath'], channels, id, radius, thresholds, shape, save=False)
+    result = cached_result(session['volumePath'], 'channels/rank',
+                           [id, radius, channels.split(','), float_list(thresholds), shape],
+                           lambda: get_edge_channels_rank(session['volumePath'], channels, id, radius, thresholds, shape, save=False))
     
     return jsonify(result), 200
 
@@ -405,7 +596,9 @@ def get_channels_clusters():
     session['thresholds'] = thresholds
     session['shape'] = shape
     
-    result = get_edge_channels_clusters(session['volumePath'], channels, id, radius, thresholds, shape, cluster_threshold, save=False)
+    result = cached_result(session['volumePath'], 'channels/clusters',
+                           [id, radius, channels.split(','), float_list(thresholds), shape, cluster_threshold],
+                           lambda: get_edge_channels_clusters(session['volumePath'], channels, id, radius, thresholds, shape, cluster_threshold, save=False))
     
     return jsonify(result), 200
     
@@ -418,13 +611,33 @@ def set_volume_path():
     else:
         return jsonify({'status':'path not found'}), 500
     
+@app.route('/jobs', methods=['GET'])
+def get_jobs():
+    return jsonify(list_jobs()), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_status(job_id)
+    if job is None:
+        return "Job not found!", 404
+    return jsonify(job), 200
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    stats = channel_cache_stats()
+    stats['results'] = result_cache_stats()
+    return jsonify(stats), 200
+
 @app.route('/precompute', methods=['DELETE'])
 def delete_precomputation():
-    with h5py.File(session['volumePath'], 'a') as f:
+    with write_volume(session['volumePath'], datasets=['intensities', 'polarization', 'colocalization']) as f:
         if 'intensities' in f.keys():
             del f['intensities']
-        if 'polarizations' in f.keys():
-            del f['polarizations']
+        if 'polarization' in f.keys():
+            del f['polarization']
+        if 'colocalization' in f.keys():
+            del f['colocalization']
+    clear_results(session['volumePath'])
     return jsonify({'status':'ok'}), 200
 
 
@@ -433,25 +646,61 @@ def start_precomputation_intensities():
     
     request_data = request.get_json()
     
-    id  = request_data['id']
+    id  = request_data.get('id', 'all')
     radii = request_data['radii']
     shape = request_data['shape']
     
+    ids = None if id == 'all' else [i.strip() for i in str(id).split(',')]
     radii = [int(r) for r in radii.split(',')]
-    precompute_edge_intensities(session['volumePath'], id, radii, shape)
-    return jsonify({'status':'ok'}), 200
+    job = submit('precomputeIntensities', precompute_edge_intensities, session['volumePath'], ids, radii, shape)
+    return jsonify({'status':'ok', 'job': job}), 202
+
+@app.route('/precomputeCellFeatures', methods=['POST'])
+def start_precomputation_cell_features():
+
+    request_data = request.get_json() or {}
+
+    labels = request_data.get('labels', 'DNA_masks')
+    channels = request_data.get('channels', None)
+    threshold = float(request_data.get('threshold', CELL_THRESHOLD))
+
+    with read_volume(session['volumePath']) as f:
+        if labels not in f['image'].keys():
+            return "Label channel not found!", 404
+    if channels is not None:
+        channels = [c.strip() for c in channels.split(',')]
+    job = submit('precomputeCellFeatures', cell_features, session['volumePath'], labels, channels, threshold)
+    return jsonify({'status':'ok', 'job': job}), 202
+
+@app.route('/pyramid', methods=['POST'])
+def start_pyramid():
+    request_data = request.get_json(silent=True) or {}
+    channels = request_data.get('channels', None)
+    if channels is not None:
+        channels = [c.strip() for c in channels.split(',')]
+    job = submit('pyramid', build_pyramid, session['volumePath'], channels)
+    return jsonify({'status':'ok', 'job': job}), 202
 
 @app.route('/precomputePolarizations', methods=['POST'])
 def start_precomputation_polarizations():
     
     request_data = request.get_json()
     
-    id  = int(request_data['id'])
     radii = request_data['radii']
+    channels = request_data.get('channels', None)
+    thresholds = request_data.get('thresholds', None)
+    mode = request_data.get('mode', '2d')
     
+    if mode not in POLARIZATION_MODES:
+        return "Invalid mode", 400
     radii = [int(r) for r in radii.split(',')]
-    precompute_polarizations(session['volumePath'], id, radii)
-    return jsonify({'status':'ok'}), 200
+    if min(radii) < 1:
+        return "Radius must be at least 1", 400
+    if channels is not None:
+        channels = [c.strip() for c in channels.split(',')]
+    thresholds = POLARIZATION_THRESHOLDS if thresholds is None else [float(t) for t in thresholds.split(',')]
+    job = submit('precomputePolarizations', precompute_polarizations, session['volumePath'], radii, channels, thresholds, mode)
+    return jsonify({'status':'ok', 'job': job}), 202
 
     
 if __name__ == '__main__':
@@ -0,0 +1,420 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+
+from graph import build_spatial_index
+
+DATASET_CACHE_SIZE = 32
+# HDF5 chunk cache of every dataset read through a pooled handle, keeps recently used chunks decompressed
+CHUNK_CACHE_BYTES = int(os.environ.get('CHUNK_CACHE_BYTES', 2 ** 27))
+CHANNEL_CACHE_BYTES = int(os.environ.get('CHANNEL_CACHE_BYTES', 2 ** 30))
+# budget of the in-memory result cache, results are sized by their JSON encoding
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 2 ** 28))
+# keep analysis results in <volume>.results.sqlite next to the volume as well, so they survive restarts
+RESULT_CACHE_SIDECAR = os.environ.get('RESULT_CACHE_SIDECAR', '0') == '1'
+
+
+class _ReadWriteLock:
+    # many concurrent readers of the pooled handle, writers get the file exclusively
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+
+    def acquire_read(self):
+        with self._condition:
+            while self._writing:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            while self._writing or self._readers > 0:
+                self._condition.wait()
+            self._writing = True
+
+    def release_write(self):
+        with self._condition:
+            self._writing = False
+            self._condition.notify_all()
+
+
+_lock = threading.RLock()
+_rw_locks = {}
+_handles = {}
+_datasets = OrderedDict()
+_channels = OrderedDict()
+_channel_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+_spatial_indices = {}
+_open_datasets = {}
+_results = OrderedDict()
+_result_stats = {'hits': 0, 'misses': 0, 'sidecar_hits': 0, 'evictions': 0, 'bytes': 0}
+_graph_versions = {}
+_write_epochs = {}
+
+
+def _reset_after_fork():
+    # handles and locks inherited from the parent must not be used in a forked worker
+    global _lock
+    _lock = threading.RLock()
+    _rw_locks.clear()
+    _handles.clear()
+    _datasets.clear()
+    _channels.clear()
+    _spatial_indices.clear()
+    _open_datasets.clear()
+    _results.clear()
+    _result_stats['bytes'] = 0
+    _graph_versions.clear()
+    _write_epochs.clear()
+    _channel_stats['bytes'] = 0
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns
+
+
+def volume_etag(path, *parts):
+    # changes whenever the file is rewritten
+    stat = os.stat(path)
+    return '-'.join(str(part) for part in (stat.st_mtime_ns, stat.st_size) + parts)
+
+
+def _depends(name, datasets):
+    # whether dataset name is one of datasets, lies in one of their groups or contains one of them
+    return datasets is None or any(name == d or name.startswith(d + '/') or d.startswith(name + '/')
+                                   for d in datasets)
+
+
+def invalidate(path, datasets=None):
+    # drop the pooled handle of path (and with it the chunk caches of its datasets) and the cached arrays that
+    # depend on datasets, the names written within the file; everything cached for path if datasets is None
+    if datasets is not None:
+        datasets = [d.strip('/') for d in datasets]
+    with _lock:
+        entry = _handles.pop(path, None)
+        if entry is not None and entry[1].id.valid:
+            entry[1].close()
+        for key in [key for key in _datasets if key[0] == path and _depends(key[1], datasets)]:
+            del _datasets[key]
+        for key in [key for key in _channels if key[0] == path and _depends('image/' + key[1], datasets)]:
+            _channel_stats['bytes'] -= _channels.pop(key).nbytes
+        if _depends('vertices', datasets) or _depends('edges', datasets):
+            _spatial_indices.pop(path, None)
+        for key in [key for key in _open_datasets if key[0] == path]:
+            del _open_datasets[key]
+
+
+def open_volume(path):
+    with _lock:
+        mtime = _mtime(path)
+        entry = _handles.get(path)
+        if entry is not None and entry[0] == mtime and entry[1].id.valid:
+            return entry[1]
+        if entry is not None:
+            invalidate(path)
+        f = h5py.File(path, 'r', rdcc_nbytes=CHUNK_CACHE_BYTES, rdcc_nslots=10007)
+        _handles[path] = (mtime, f)
+        return f
+
+
+def _path_lock(path):
+    # one lock per file, a writer only blocks the readers of the file it writes
+    with _lock:
+        if path not in _rw_locks:
+            _rw_locks[path] = _ReadWriteLock()
+        return _rw_locks[path]
+
+
+@contextmanager
+def read_volume(path):
+    rw_lock = _path_lock(path)
+    rw_lock.acquire_read()
+    try:
+        yield open_volume(path)
+    finally:
+        rw_lock.release_read()
+
+
+@contextmanager
+def lock_volume(path, datasets=None):
+    # exclusive access to path without opening it, e.g. to replace the file; datasets names what is written,
+    # cached arrays of other datasets stay valid (all of them are dropped if None)
+    rw_lock = _path_lock(path)
+    rw_lock.acquire_write()
+    before = volume_etag(path) if os.path.exists(path) else None
+    try:
+        invalidate(path, datasets)
+        yield
+    finally:
+        invalidate(path, datasets)
+        _note_write(path, before)
+        rw_lock.release_write()
+
+
+@contextmanager
+def write_volume(path, mode='a', datasets=None):
+    # datasets: the datasets or groups written, see lock_volume; a truncating mode always drops everything
+    with lock_volume(path, datasets if mode in ['a', 'r+'] else None):
+        with h5py.File(path, mode) as f:
+            yield f
+
+
+def open_dataset(f, name):
+    # HDF5 keeps its chunk cache per open dataset, reusing the dataset object of the pooled handle
+    # keeps decompressed chunks around between requests; use inside read_volume
+    key = (f.filename, name)
+    with _lock:
+        dataset = _open_datasets.get(key)
+        if dataset is None or not dataset.id.valid:
+            dataset = f[name]
+            _open_datasets[key] = dataset
+        return dataset
+
+
+def read_dataset(path, name):
+    with read_volume(path) as f:
+        with _lock:
+            key = (path, name)
+            if key in _datasets:
+                _datasets.move_to_end(key)
+                return _datasets[key]
+            if name not in f:
+                return None
+            data = f[name][()]
+            if hasattr(data, 'flags'):
+                data.flags.writeable = False
+            _datasets[key] = data
+            while len(_datasets) > DATASET_CACHE_SIZE:
+                _datasets.popitem(last=False)
+            return data
+
+
+def get_spatial_index(path):
+    # built on first use per volume and dropped whenever the file changes
+    vertices = read_dataset(path, 'vertices')
+    edges = read_dataset(path, 'edges')
+    with _lock:
+        if path in _spatial_indices:
+            return _spatial_indices[path]
+    index = build_spatial_index(vertices if vertices is not None else np.zeros((0, 3)),
+                                edges if edges is not None else np.zeros((0, 2), dtype=int))
+    with _lock:
+        _spatial_indices[path] = index
+    return index
+
+
+def _evict_channels():
+    while _channels and _channel_stats['bytes'] > CHANNEL_CACHE_BYTES:
+        _channel_stats['bytes'] -= _channels.popitem(last=False)[1].nbytes
+        _channel_stats['evictions'] += 1
+
+
+def channel_nbytes(path, channel, binary=False):
+    with read_volume(path) as f:
+        dataset = f['image'][channel]
+        return int(np.prod(dataset.shape)) * (1 if binary else dataset.dtype.itemsize)
+
+
+def channel_fits(path, channel, count=1, binary=False):
+    # whether count channels of this size can be held in the channel cache at the same time
+    return count * channel_nbytes(path, channel, binary) <= CHANNEL_CACHE_BYTES
+
+
+def get_channel(path, channel, threshold=None, binary=False):
+    # thresholded channel volume, values <= threshold set to 0 (or a boolean mask if binary)
+    key = (path, channel, threshold, binary)
+    with _lock:
+        if key in _channels:
+            _channel_stats['hits'] += 1
+            _channels.move_to_end(key)
+            return _channels[key]
+        _channel_stats['misses'] += 1
+
+    with read_volume(path) as f:
+        volume = f['image'][channel][:]
+    if binary:
+        volume = volume > (threshold if threshold is not None else 0)
+    elif threshold is not None:
+        volume = np.where(volume > threshold, volume, 0).astype(volume.dtype)
+    volume.flags.writeable = False
+
+    with _lock:
+        if volume.nbytes <= CHANNEL_CACHE_BYTES and key not in _channels:
+            _channels[key] = volume
+            _channel_stats['bytes'] += volume.nbytes
+            _evict_channels()
+    return volume
+
+
+def channel_cache_stats():
+    with _lock:
+        stats = dict(_channel_stats)
+        stats['entries'] = len(_channels)
+        stats['budget'] = CHANNEL_CACHE_BYTES
+        return stats
+
+
+def _store_epoch(path, entry):
+    if RESULT_CACHE_SIDECAR:
+        with _sidecar(path) as connection:
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('epoch', ?)", (json.dumps(entry),))
+
+
+def _note_write(path, before):
+    # a write of this process keeps the epoch, as long as nothing else changed the file since it was last seen
+    with _lock:
+        entry = _write_epochs.get(path)
+        if entry is None:
+            return
+        if entry[0] != before or not os.path.exists(path):
+            del _write_epochs[path]
+            return
+        entry = (volume_etag(path), entry[1])
+        _write_epochs[path] = entry
+    _store_epoch(path, entry)
+
+
+def write_epoch(path):
+    # token that changes whenever the file was modified other than through write_volume or lock_volume of this
+    # process, e.g. a channel rewritten in place by a script; kept in the sidecar so it survives restarts
+    tag = volume_etag(path)
+    with _lock:
+        entry = _write_epochs.get(path)
+    if entry is None and RESULT_CACHE_SIDECAR and os.path.exists(_sidecar_path(path)):
+        with _sidecar(path) as connection:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()
+        if row is not None:
+            entry = tuple(json.loads(row[0]))
+    if entry is None or entry[0] != tag:
+        entry = (tag, uuid.uuid4().hex)
+        _store_epoch(path, entry)
+    with _lock:
+        _write_epochs[path] = entry
+    return entry[1]
+
+
+def graph_version(path):
+    # content hash of the graph and the channel layout of the volume plus its write epoch, the channel contents
+    # are too large to hash; rehashed only when the file changed
+    tag = volume_etag(path)
+    epoch = write_epoch(path)
+    with _lock:
+        entry = _graph_versions.get(path)
+        if entry is not None and entry[0] == (tag, epoch):
+            return entry[1]
+    digest = hashlib.sha1(epoch.encode())
+    for name in ['vertices', 'edges']:
+        data = read_dataset(path, name)
+        if data is not None:
+            digest.update('{}{}{}'.format(name, data.shape, data.dtype).encode())
+            digest.update(np.ascontiguousarray(data).tobytes())
+    with read_volume(path) as f:
+        for name, dataset in f['image'].items():
+            digest.update('{}{}{}'.format(name, dataset.shape, dataset.dtype).encode())
+    version = digest.hexdigest()
+    with _lock:
+        _graph_versions[path] = ((tag, epoch), version)
+    return version
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{} is not JSON serializable".format(type(value)))
+
+
+def _sidecar_path(path):
+    return path + '.results.sqlite'
+
+
+@contextmanager
+def _sidecar(path):
+    connection = sqlite3.connect(_sidecar_path(path), timeout=30)
+    try:
+        connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        yield connection
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def cached_result(path, name, params, compute):
+    # result of compute() memoized on the endpoint name, its normalized parameters and the graph version
+    key = json.dumps([name, graph_version(path), params], sort_keys=True, default=_to_json)
+    with _lock:
+        if (path, key) in _results:
+            _result_stats['hits'] += 1
+            _results.move_to_end((path, key))
+            return _results[(path, key)][0]
+        _result_stats['misses'] += 1
+
+    result = None
+    encoded = None
+    if RESULT_CACHE_SIDECAR and os.path.exists(_sidecar_path(path)):
+        with _sidecar(path) as connection:
+            row = connection.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            encoded = row[0]
+            result = json.loads(encoded)
+            with _lock:
+                _result_stats['sidecar_hits'] += 1
+    if result is None:
+        result = compute()
+        encoded = json.dumps(result, default=_to_json)
+        if RESULT_CACHE_SIDECAR:
+            with _sidecar(path) as connection:
+                connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?)', (key, encoded))
+
+    # the decoded lists take a multiple of the JSON size, which still orders results by their memory use
+    nbytes = len(encoded)
+    with _lock:
+        if nbytes <= RESULT_CACHE_BYTES and (path, key) not in _results:
+            _results[(path, key)] = (result, nbytes)
+            _result_stats['bytes'] += nbytes
+            while _result_stats['bytes'] > RESULT_CACHE_BYTES:
+                _result_stats['bytes'] -= _results.popitem(last=False)[1][1]
+                _result_stats['evictions'] += 1
+    return result
+
+
+def clear_results(path):
+    # also starts a new write epoch, results cached before can not come back
+    with _lock:
+        for key in [key for key in _results if key[0] == path]:
+            _result_stats['bytes'] -= _results.pop(key)[1]
+        _write_epochs.pop(path, None)
+        _graph_versions.pop(path, None)
+    if os.path.exists(_sidecar_path(path)):
+        with _sidecar(path) as connection:
+            connection.execute('DELETE FROM results')
+            connection.execute('DELETE FROM meta')
+
+
+def result_cache_stats():
+    with _lock:
+        stats = dict(_result_stats)
+        stats['entries'] = len(_results)
+        stats['budget'] = RESULT_CACHE_BYTES
+        stats['sidecar'] = RESULT_CACHE_SIDECAR
+        return stats
@@ -0,0 +1,179 @@
+import sys
+import time
+
+import numpy as np
+import scipy.spatial as sptl
+
+
+def pack_pairs(pairs, n):
+    # one int64 key per undirected pair, (i, j) and (j, i) map to the same key
+    pairs = np.sort(np.asarray(pairs, dtype=np.int64), axis=1)
+    return pairs[:, 0] * n + pairs[:, 1]
+
+
+def unpack_pairs(keys, n):
+    return np.stack([keys // n, keys % n], axis=1)
+
+
+def get_delaunay_edges(points):
+    # unique undirected edges (i < j, sorted) of the Delaunay triangulation
+    tri = sptl.Delaunay(points)
+    indptr, indices = tri.vertex_neighbor_vertices
+    rows = np.repeat(np.arange(tri.npoints), np.diff(indptr))
+    keys = np.unique(pack_pairs(np.stack([rows, indices], axis=1), tri.npoints))
+    delaunay_conns = unpack_pairs(keys, tri.npoints)
+    return delaunay_conns, tri
+
+
+def is_gabriel(points, conns, tree=None):
+    # an edge is kept if no point is closer to its midpoint than half its length (the diametral ball is empty)
+    c = points[conns]
+    m = (c[:, 0, :] + c[:, 1, :]) / 2
+    r = np.sqrt(np.sum((c[:, 0, :] - c[:, 1, :]) ** 2, axis=1)) / 2
+    if tree is None:
+        tree = sptl.cKDTree(points)
+    n = tree.query(x=m, k=1, workers=-1)[0]
+    return n >= r * (0.999)
+
+
+def get_gabriel_graph(tri, delaunay_conns, points=None, min_dist=10):
+    if points is None:
+        points = tri.points
+    points = np.asarray(points, dtype=float)
+    conns = np.unique(pack_pairs(delaunay_conns, len(points)))
+    conns = unpack_pairs(conns, len(points))
+    return conns[is_gabriel(points, conns)]
+
+
+def resolve_vertices(vertices, coords, tolerance):
+    # index of the vertex nearest to each coordinate if it is within tolerance, -1 otherwise
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    if len(coords) == 0 or len(vertices) == 0:
+        return np.full(len(coords), -1, dtype=np.int64)
+    distances, indices = sptl.cKDTree(vertices).query(coords, k=1, distance_upper_bound=tolerance)
+    return np.where(np.isinf(distances), -1, indices).astype(np.int64)
+
+
+def update_gabriel_graph(points, edges, vertex_remap, changed):
+    # Gabriel graph of points after an edit of the point set that produced edges. vertex_remap maps old
+    # vertex indices to new ones (-1 if deleted), changed holds the coordinates of deleted and inserted points.
+    # Only edges touching an inserted point or with a changed point in their diametral ball are re-tested,
+    # all other edges keep their old status. Surviving edges keep their order, new ones are appended;
+    # returns the new edges and the old -> new edge index map (-1 if removed)
+    points = np.asarray(points, dtype=float)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    vertex_remap = np.asarray(vertex_remap, dtype=np.int64)
+    changed = np.asarray(changed, dtype=float).reshape(-1, 3)
+    n = len(points)
+
+    old = vertex_remap[edges]
+    alive = np.all(old >= 0, axis=1)
+    old_keys = pack_pairs(old[alive], n)
+
+    delaunay_conns = np.zeros((0, 2), dtype=np.int64)
+    if n >= 4:
+        try:
+            delaunay_conns, tri = get_delaunay_edges(points)
+        except sptl.QhullError:
+            # coplanar or otherwise degenerate point sets have no 3D triangulation
+            pass
+    keys = pack_pairs(delaunay_conns, n)
+    gabriel = np.isin(keys, old_keys)
+
+    inserted = np.ones(n, dtype=bool)
+    inserted[vertex_remap[vertex_remap >= 0]] = False
+    dirty = np.any(inserted[delaunay_conns], axis=1)
+    if len(changed) and len(delaunay_conns):
+        c = points[delaunay_conns]
+        m = (c[:, 0, :] + c[:, 1, :]) / 2
+        r = np.sqrt(np.sum((c[:, 0, :] - c[:, 1, :]) ** 2, axis=1)) / 2
+        d = sptl.cKDTree(changed).query(m, k=1, distance_upper_bound=r.max() + 1, workers=-1)[0]
+        dirty |= d <= r
+    if dirty.any():
+        gabriel[dirty] = is_gabriel(points, delaunay_conns[dirty])
+    gabriel_keys = keys[gabriel]
+
+    survives = np.zeros(len(edges), dtype=bool)
+    survives[alive] = np.isin(old_keys, gabriel_keys)
+    kept_keys = pack_pairs(old[survives], n)
+    appended = unpack_pairs(np.setdiff1d(gabriel_keys, kept_keys), n)
+    new_edges = np.concatenate([unpack_pairs(kept_keys, n), appended]).astype(edges.dtype)
+
+    edge_remap = np.full(len(edges), -1, dtype=np.int64)
+    edge_remap[survives] = np.arange(np.count_nonzero(survives))
+    return new_edges, edge_remap
+
+
+def build_spatial_index(vertices, edges):
+    # KD-trees over the vertices and the edge midpoints, edge queries are padded by the longest half edge
+    vertices = np.asarray(vertices, dtype=float).reshape(-1, 3)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    starts, ends = vertices[edges[:, 0]], vertices[edges[:, 1]]
+    midpoints = (starts + ends) / 2
+    half_extent = np.abs(ends - starts) / 2
+    return {'vertices': vertices, 'vertex_tree': sptl.cKDTree(vertices), 'edges': edges,
+            'starts': starts, 'ends': ends, 'edge_tree': sptl.cKDTree(midpoints),
+            'edge_pad': float(half_extent.max()) if len(edges) else 0.0,
+            'edge_length': float(np.sqrt(np.sum((ends - starts) ** 2, axis=1)).max() / 2) if len(edges) else 0.0}
+
+
+def _box_candidates(tree, lo, hi, pad=0.0):
+    if tree.n == 0:
+        return np.zeros(0, dtype=np.int64)
+    center = (lo + hi) / 2
+    return np.array(tree.query_ball_point(center, np.max(hi - lo) / 2 + pad, p=np.inf), dtype=np.int64)
+
+
+def vertices_in_box(index, lo, hi):
+    lo, hi = np.asarray(lo, dtype=float), np.asarray(hi, dtype=float)
+    candidates = _box_candidates(index['vertex_tree'], lo, hi)
+    v = index['vertices'][candidates]
+    return np.sort(candidates[np.all((v >= lo) & (v <= hi), axis=1)])
+
+
+def vertices_near(index, point, radius):
+    if index['vertex_tree'].n == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.sort(np.array(index['vertex_tree'].query_ball_point(point, radius), dtype=np.int64))
+
+
+def edges_in_box(index, lo, hi):
+    # edges whose bounding box intersects the box
+    lo, hi = np.asarray(lo, dtype=float), np.asarray(hi, dtype=float)
+    candidates = _box_candidates(index['edge_tree'], lo, hi, index['edge_pad'])
+    starts, ends = index['starts'][candidates], index['ends'][candidates]
+    inside = np.all((np.minimum(starts, ends) <= hi) & (np.maximum(starts, ends) >= lo), axis=1)
+    return np.sort(candidates[inside])
+
+
+def edges_near(index, point, radius):
+    # edges whose segment passes within radius of the point
+    point = np.asarray(point, dtype=float)
+    if index['edge_tree'].n == 0:
+        return np.zeros(0, dtype=np.int64)
+    candidates = np.array(index['edge_tree'].query_ball_point(point, radius + index['edge_length']),
+                          dtype=np.int64)
+    starts, ends = index['starts'][candidates], index['ends'][candidates]
+    direction = ends - starts
+    length_sq = np.sum(direction ** 2, axis=1)
+    t = np.sum((point - starts) * direction, axis=1) / np.where(length_sq > 0, length_sq, 1)
+    closest = starts + np.clip(t, 0, 1)[:, None] * direction
+    return np.sort(candidates[np.sum((closest - point) ** 2, axis=1) <= radius ** 2])
+
+
+if __name__ == '__main__':
+    # python graph.py [max_points]: Delaunay + Gabriel timings for 10^3 up to max_points (default 10^6) points
+    max_points = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6
+    rng = np.random.default_rng(0)
+    n = 1000
+    while n <= max_points:
+        points = rng.integers(0, int(round(n ** (1 / 3))) * 20, size=(n, 3))
+        start = time.perf_counter()
+        delaunay_conns, tri = get_delaunay_edges(points)
+        delaunay_time = time.perf_counter() - start
+        start = time.perf_counter()
+        gabriel_conns = get_gabriel_graph(tri, delaunay_conns, points)
+        gabriel_time = time.perf_counter() - start
+        print("{:>8} points: {:>9} delaunay edges in {:.2f}s, {:>8} gabriel edges in {:.2f}s".format(
+            n, len(delaunay_conns), delaunay_time, len(gabriel_conns), gabriel_time))
+        n *= 10
@@ -0,0 +1,102 @@
+import os
+
+import h5py
+import numpy as np
+import tifffile
+
+from cache import clear_results, invalidate, lock_volume
+from jobs import no_progress
+from volume import build_pyramid
+
+SLAB_DEPTH = 8
+CHUNKS = (SLAB_DEPTH, 256, 256)
+
+
+def _page_indices(series):
+    # pages of a (Z, C, Y, X) hyperstack (or C, Z, Y, X) in file order, indexed as [channel][z]
+    lead_shape = series.shape[:-2]
+    if len(lead_shape) != 2:
+        raise ValueError("Expected a 4D (Z, C, Y, X) TIFF series, got axes {}".format(series.axes))
+    axes = series.axes[:-2]
+    c_axis = axes.index('C') if 'C' in axes else 1
+    n_channels = lead_shape[c_axis]
+    n_z = lead_shape[1 - c_axis]
+    indices = np.zeros((n_channels, n_z), dtype=int)
+    for c in range(n_channels):
+        for z in range(n_z):
+            index = (z, c) if c_axis == 1 else (c, z)
+            indices[c, z] = np.ravel_multi_index(index, lead_shape)
+    return indices
+
+
+def _plane_reader(series):
+    # (n_channels, n_z, plane shape, read(c, z)) of a 4D TIFF series. Channels are either separate (Y, X) pages
+    # or, for plain 3 and 4 channel TIFFs which tifffile reads as planar RGB, the samples of one page per z
+    pages = series.pages
+    if 'S' in series.axes:
+        if len(series.shape) != 4:
+            raise ValueError("Expected a 4D (Z, C, Y, X) TIFF series, got axes {}".format(series.axes))
+        n_channels = series.shape[series.axes.index('S')]
+        n_z = series.shape[[i for i, axis in enumerate(series.axes) if axis not in 'SYX'][0]]
+        plane_shape = tuple(series.shape[series.axes.index(axis)] for axis in 'YX')
+        sample_axis = pages[0].axes.index('S')
+        if len(pages) != n_z:
+            raise ValueError("Expected one page per z-slice, got {} pages for {} slices".format(len(pages), n_z))
+        return n_channels, n_z, plane_shape, lambda c, z: np.take(pages[z].asarray(), c, axis=sample_axis)
+
+    indices = _page_indices(series)
+    plane_shape = tuple(series.shape[-2:])
+    if indices.size != len(pages) or tuple(pages[0].shape) != plane_shape:
+        raise ValueError("Expected one (Y, X) page per plane, got {} pages of shape {} for axes {}".format(
+            len(pages), pages[0].shape, series.axes))
+    n_channels, n_z = indices.shape
+    return n_channels, n_z, plane_shape, lambda c, z: pages[int(indices[c, z])].asarray()
+
+
+def ingest_tiff(tiff_path, h5_path, channel_names=None, create_graph=True, pyramid=True, progress=no_progress):
+    # streams a multi-channel TIFF into image/<channel> float32 datasets normalized by the channel maximum,
+    # holding at most one z-slab of one channel in memory; the file only appears at h5_path once complete
+    part_path = h5_path + '.part'
+    try:
+        with tifffile.TiffFile(tiff_path) as tif:
+            n_channels, n_z, plane_shape, read_plane = _plane_reader(tif.series[0])
+            if channel_names is None:
+                channel_names = [str(c) for c in range(n_channels)]
+
+            maxima = np.zeros(n_channels, dtype=np.float64)
+            for c in range(n_channels):
+                for z in range(n_z):
+                    maxima[c] = max(maxima[c], read_plane(c, z).max())
+                progress(0.4 * (c + 1) / n_channels, 'Scanning channel {}'.format(channel_names[c]))
+            maxima[maxima == 0] = 1
+
+            with h5py.File(part_path, 'w') as cube:
+                chunks = (min(CHUNKS[0], n_z),) + tuple(min(c, s) for c, s in zip(CHUNKS[1:], plane_shape))
+                for c, name in enumerate(channel_names[:n_channels]):
+                    dataset = cube.create_dataset('image/{}'.format(name), shape=(n_z,) + tuple(plane_shape),
+                                                  dtype=np.float32, chunks=chunks, compression='gzip',
+                                                  compression_opts=1, shuffle=True)
+                    for z in range(0, n_z, SLAB_DEPTH):
+                        slab = np.stack([read_plane(c, i) for i in range(z, min(z + SLAB_DEPTH, n_z))])
+                        slab = np.array(slab, dtype=np.float32)
+                        slab /= np.float32(maxima[c])
+                        dataset[z:z + slab.shape[0]] = slab
+                    progress(0.4 + 0.5 * (c + 1) / n_channels, 'Writing channel {}'.format(name))
+                if create_graph:
+                    cube.create_dataset('edges', shape=(0, 2), dtype=int, chunks=True, maxshape=(None, 2))
+                    cube.create_dataset('vertices', shape=(0, 3), dtype=int, chunks=True, maxshape=(None, 3))
+
+        if pyramid:
+            progress(0.9, 'Building pyramid')
+            build_pyramid(part_path)
+    except BaseException:
+        invalidate(part_path)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    # readers of a previous version of the file finish before it is replaced
+    with lock_volume(h5_path):
+        os.replace(part_path, h5_path)
+    clear_results(h5_path)
+    progress(1.0, 'Done')
+    return h5_path
@@ -0,0 +1,94 @@
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+WORKERS = os.cpu_count()
+
+_lock = threading.Lock()
+_jobs = {}
+_queue = queue.Queue()
+_dispatcher = None
+_pool = None
+
+
+def get_pool():
+    # process pool shared by all jobs, created on first use and kept for the lifetime of the server;
+    # spawned rather than forked so long-lived workers do not hold on to inherited HDF5 handles and file locks
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=mp.get_context('spawn'))
+        return _pool
+
+
+def no_progress(fraction, message=None):
+    # progress callback for functions called outside of a job
+    return
+
+
+def _update(job_id, **fields):
+    with _lock:
+        _jobs[job_id].update(fields)
+
+
+def _run(job_id, fn, args, kwargs):
+    def progress(fraction, message=None):
+        fields = {'progress': float(fraction)}
+        if message is not None:
+            fields['message'] = message
+        _update(job_id, **fields)
+
+    _update(job_id, status='running', started=time.time())
+    try:
+        result = fn(*args, progress=progress, **kwargs)
+        _update(job_id, status='done', progress=1.0, result=result, finished=time.time())
+    except Exception as e:
+        traceback.print_exc()
+        _update(job_id, status='failed', error=str(e), finished=time.time())
+
+
+def _dispatch():
+    # jobs run one after another on this thread, which makes it the only writer of job results;
+    # the heavy lifting inside a job is fanned out to get_pool()
+    while True:
+        job_id, fn, args, kwargs = _queue.get()
+        _run(job_id, fn, args, kwargs)
+
+
+def submit(name, fn, *args, **kwargs):
+    # queue fn(*args, progress=callback, **kwargs) and return the job id
+    global _dispatcher
+    job_id = uuid.uuid4().hex
+    with _lock:
+        _jobs[job_id] = {'id': job_id, 'name': name, 'status': 'queued', 'progress': 0.0, 'message': '',
+                         'error': None, 'result': None, 'submitted': time.time(), 'started': None, 'finished': None}
+        if _dispatcher is None:
+            _dispatcher = threading.Thread(target=_dispatch, daemon=True)
+            _dispatcher.start()
+    _queue.put((job_id, fn, args, kwargs))
+    return job_id
+
+
+def _with_eta(job):
+    job['eta'] = None
+    if job['status'] == 'running' and job['progress'] > 0:
+        elapsed = time.time() - job['started']
+        job['eta'] = elapsed * (1 - job['progress']) / job['progress']
+    return job
+
+
+def job_status(job_id):
+    with _lock:
+        if job_id not in _jobs:
+            return None
+        return _with_eta(dict(_jobs[job_id]))
+
+
+def list_jobs():
+    with _lock:
+        return [_with_eta(dict(job)) for job in _jobs.values()]
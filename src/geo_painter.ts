@@ -330,6 +330,12 @@ export class GeoPainter {
           }
           return response.json();
         })
+        .then((remap) => {
+          // edge ids of untouched edges can shift after an edit
+          this.selectedEdge = this.selectedEdge
+              .map((id) => remap['edges'][id - 1])
+              .filter((id) => id !== undefined && id > 0);
+        })
         .catch((error) => {
           console.error('There was a problem with the fetch operation:', error);
         }).then(() => {
@@ -8,6 +8,46 @@ document
     .getElementById('precomputeDeleteButton')!
     .addEventListener('click', deletePrecomputation);
 
+const ingestJob = document.getElementById('ingestJob')!.dataset.job;
+if (ingestJob) {
+  waitForIngestion(ingestJob);
+}
+
+async function waitForIngestion(jobId: string) {
+  const job = await waitForJob(jobId, 'Converting volume');
+  if (job['status'] === 'done') {
+    document.getElementById('startViewer')!.click();
+  }
+}
+
+async function waitForJob(jobId: string, label: string) {
+  const progressValue = document.getElementById('progressBarText');
+  progressValue!.innerHTML = `${label} ... 0%`;
+  progressValue!.style.display = 'block';
+
+  const progressBar = document.getElementById('progressBar');
+  const progressBarContainer = document.getElementById('progressBarContainer');
+  progressBarContainer!.style.display = 'block';
+  progressBar!.style.width = 0 + '%';
+
+  for (;;) {
+    const job = await fetch(`http://localhost:8080/jobs/${jobId}`)
+        .then((response) => response.json());
+    const percentages = Math.round(job['progress'] * 100.0);
+    const eta = job['eta'] !== null ? ` (${Math.ceil(job['eta'])}s left)` : '';
+    progressBar!.style.width = percentages + '%';
+    progressValue!.innerHTML = `${label} ... ${percentages}%${eta}`;
+
+    if (job['status'] === 'failed') {
+      alert('Error: ' + job['error']);
+    }
+    if (job['status'] === 'done' || job['status'] === 'failed') {
+      return job;
+    }
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+  }
+}
+
 async function precompute() {
   const volumePath = (document.getElementById('volumePath') as any)!.value;
 
@@ -33,82 +73,33 @@ async function precompute() {
 }
 
 async function precomputeIntensities() {
-  const edgeIds: string[] = [];
-
   const shapeSelect: any = document.getElementById('shape')!;
   const shape = shapeSelect.options[shapeSelect.selectedIndex].value;
 
-  const progressValue = document.getElementById('progressBarText');
-  progressValue!.innerHTML = 'Precomputing all interactions ... 0%';
-  progressValue!.style.display = 'block';
-
-  const progressBar = document.getElementById('progressBar');
-  const progressBarContainer = document.getElementById('progressBarContainer');
-  progressBarContainer!.style.display = 'block';
-  progressBar!.style.width = 0 + '%';
-
-  await fetch('http://localhost:8080/edges')
-      .then((response) => response.json())
-      .then((data) => {
-        data.map((item: any) => edgeIds.push(item['id']));
-      });
-
   const radii = [5, 10, 15, 20, 25, 30];
-  let i = 0;
-  for (const edgeId of edgeIds) {
-    await fetch('http://localhost:8080/precomputeIntensities', {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({
-        id: `${edgeId}`, radii: `${radii}`, shape: `${shape}`}),
-    });
-
-    i++;
-    const percentages = Math.round((i / edgeIds.length) * 100.0);
-    progressBar!.style.width = percentages + '%';
-    progressValue!.innerHTML =
-    `Precomputing all interactions ... ${percentages}%`;
-  }
+  const job = await fetch('http://localhost:8080/precomputeIntensities', {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({
+      id: 'all', radii: `${radii}`, shape: `${shape}`}),
+  }).then((response) => response.json());
+
+  await waitForJob(job['job'], 'Precomputing all interactions');
 }
 
 async function precomputePolarizations() {
-  const vertexIds: string[] = [];
-
-  const progressValue = document.getElementById('progressBarText');
-  progressValue!.innerHTML = 'Precomputing all polarizations ... 0%';
-  progressValue!.style.display = 'block';
-
-  const progressBar = document.getElementById('progressBar');
-  progressBar!.style.width = 0 + '%';
-  const progressBarContainer = document.getElementById('progressBarContainer');
-  progressBarContainer!.style.display = 'block';
-
-  await fetch('http://localhost:8080/vertices')
-      .then((response) => response.json())
-      .then((data) => {
-        data.map((item: any) => vertexIds.push(item['id']));
-      });
-
   const radii = [5, 10, 15, 20, 25, 30];
-  let i = 0;
-  for (const vertexId of vertexIds) {
-    await fetch('http://localhost:8080/precomputePolarizations', {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({
-        id: `${vertexId}`, radii: `${radii}`}),
-    });
-
-    i++;
-    const percentages = Math.round((i / vertexIds.length) * 100.0);
-    progressBar!.style.width = percentages + '%';
-    progressValue!.innerHTML =
-    `Precomputing all polarizations ... ${percentages}%`;
-  }
+  const job = await fetch('http://localhost:8080/precomputePolarizations', {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({radii: `${radii}`}),
+  }).then((response) => response.json());
+
+  await waitForJob(job['job'], 'Precomputing all polarizations');
 }
 
 
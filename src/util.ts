@@ -112,7 +112,7 @@ function editingMouseDown(raycaster: THREE.Raycaster, app: App,
 export async function fetchImage(
     dim: string, x: number, y: number, z: number, channel: string) {
   // eslint-disable-next-line max-len
-  const url = `http://localhost:8080/slice/${dim}?x=${x.toString()}&y=${y.toString()}&z=${z.toString()}&channel=${channel}`;
+  const url = `http://localhost:8080/slice/${dim}?x=${x.toString()}&y=${y.toString()}&z=${z.toString()}&channel=${channel}&format=webp`;
 
   const options = {
     method: 'GET',
@@ -120,20 +120,19 @@ export async function fetchImage(
 
   const response = await fetch(url, options);
 
-  const data = await response.json();
-  const bytestring = data['status'];
-  const rawImage = bytestring.split('\'')[1];
+  const blob = await response.blob();
 
   const image = document.createElement('img');
 
   image.className = 'slice_view';
   image.classList.add(dim);
-  image.src = 'data:image/jpeg;base64,' + rawImage;
+  image.src = URL.createObjectURL(blob);
 
   const container = document.getElementById('slice_view_box')!;
   for (let i = 0; i < container.children.length; i++) {
-    const child = container.children[i];
+    const child = container.children[i] as HTMLImageElement;
     if (child.classList.contains(dim)) {
+      URL.revokeObjectURL(child.src);
       container.removeChild(child);
     }
   }
@@ -3,8 +3,11 @@ import {Volume} from './volume_painter';
 export class WorkerClass {
   constructor() {}
   async getVolume(marker: string): Promise<Volume> {
-    const volume =
-    (await fetch('volume/' + marker)).json() as unknown as Volume;
-    return volume;
+    const response =
+    await fetch('volume/' + marker + '/raw?compression=gzip');
+    const [zLength, yLength, xLength] =
+    response.headers.get('X-Volume-Shape')!.split(',').map(Number);
+    const data = new Uint8Array(await response.arrayBuffer());
+    return {xLength, yLength, zLength, data};
   }
 }
@@ -0,0 +1,45 @@
+import h5py
+import numpy as np
+
+import cache
+
+
+def make_volume(path):
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('image/a', data=np.random.default_rng(0).random((8, 8, 8), dtype=np.float32))
+        f.create_dataset('vertices', data=np.array([[1, 1, 1], [5, 5, 5]]))
+        f.create_dataset('edges', data=np.array([[0, 1]]))
+
+
+def test_write_keeps_unrelated_caches(tmp_path):
+    path = str(tmp_path / 'volume.h5')
+    make_volume(path)
+    channel = cache.get_channel(path, 'a', 0.5)
+    vertices = cache.read_dataset(path, 'vertices')
+    index = cache.get_spatial_index(path)
+
+    with cache.write_volume(path, datasets=['pyramid']) as f:
+        f.create_dataset('pyramid/1/a', data=np.zeros((4, 4, 4), dtype=np.uint8))
+    assert cache.get_channel(path, 'a', 0.5) is channel
+    assert cache.read_dataset(path, 'vertices') is vertices
+    assert cache.get_spatial_index(path) is index
+    assert cache.read_dataset(path, 'pyramid/1/a').shape == (4, 4, 4)
+
+    with cache.write_volume(path, datasets=['vertices']) as f:
+        f['vertices'][0] = [2, 2, 2]
+    assert cache.get_channel(path, 'a', 0.5) is channel
+    vertices = cache.read_dataset(path, 'vertices')
+    assert vertices[0].tolist() == [2, 2, 2]
+    assert cache.get_spatial_index(path) is not index
+
+    with cache.write_volume(path, datasets=['image/a']) as f:
+        f['image/a'][...] = 1
+    assert np.all(cache.get_channel(path, 'a', 0.5) == 1)
+
+    with cache.write_volume(path, datasets=['image/a']) as f:
+        pass
+    assert cache.read_dataset(path, 'vertices') is vertices
+    with cache.write_volume(path) as f:
+        pass
+    assert cache.read_dataset(path, 'vertices') is not vertices
+    cache.invalidate(path)
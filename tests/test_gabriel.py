@@ -0,0 +1,51 @@
+import numpy as np
+
+from graph import get_delaunay_edges, get_gabriel_graph, pack_pairs, update_gabriel_graph
+
+
+def full_rebuild(points):
+    delaunay_conns, tri = get_delaunay_edges(points)
+    return get_gabriel_graph(tri, delaunay_conns, points)
+
+
+def random_edit(rng, points, n_delete, n_insert):
+    keep = np.ones(len(points), dtype=bool)
+    keep[rng.choice(len(points), n_delete, replace=False)] = False
+    vertex_remap = np.full(len(points), -1, dtype=np.int64)
+    vertex_remap[keep] = np.arange(np.count_nonzero(keep))
+    inserted = rng.integers(0, 60, size=(n_insert, 3))
+    new_points = np.concatenate([points[keep], inserted])
+    changed = np.concatenate([points[~keep], inserted])
+    return new_points, vertex_remap, changed
+
+
+def test_incremental_update_matches_full_rebuild():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        points = np.unique(rng.integers(0, 60, size=(int(rng.integers(20, 200)), 3)), axis=0)
+        edges = full_rebuild(points)
+        new_points, vertex_remap, changed = random_edit(rng, points, int(rng.integers(0, 5)), int(rng.integers(0, 5)))
+        if len(np.unique(new_points, axis=0)) < len(new_points):
+            continue
+        new_edges, edge_remap = update_gabriel_graph(new_points, edges, vertex_remap, changed)
+        expected = full_rebuild(new_points)
+        n = len(new_points)
+        assert np.array_equal(np.sort(pack_pairs(new_edges, n)), np.sort(pack_pairs(expected, n)))
+        # surviving edges keep their relative order and map to the same vertex pair
+        kept = edge_remap >= 0
+        assert np.all(np.diff(edge_remap[kept]) > 0)
+        assert np.array_equal(pack_pairs(vertex_remap[edges[kept]], n), pack_pairs(new_edges[edge_remap[kept]], n))
+
+
+def test_four_points_are_triangulated():
+    points = np.array([[0, 0, 0], [10, 0, 0], [0, 10, 0], [0, 0, 10], [10, 10, 10]])
+    edges = full_rebuild(points)
+    new_edges, _ = update_gabriel_graph(points[:4], edges, np.array([0, 1, 2, 3, -1]), points[4:])
+    assert len(new_edges) > 0
+    assert np.array_equal(np.sort(pack_pairs(new_edges, 4)), np.sort(pack_pairs(full_rebuild(points[:4]), 4)))
+
+
+def test_coplanar_points_have_no_edges():
+    points = np.array([[0, 0, 0], [0, 10, 0], [0, 0, 10], [0, 10, 10], [0, 20, 5]])
+    edges, edge_remap = update_gabriel_graph(points, np.zeros((0, 2), dtype=int), np.arange(5), np.zeros((0, 3)))
+    assert len(edges) == 0
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from analysis import get_shape_voxels
+
+
+def reference_shape_voxels(v1, v2, radius, dims, shape):
+    # the original per-voxel projection / arccos implementation
+    voxels = set()
+    vec = v2 - v1
+    dist = np.linalg.norm(vec)
+    if shape == 'cylinder':
+        bounding_box_min = np.maximum(np.minimum(v1, v2) - radius, 0).astype(int)
+        bounding_box_max = np.minimum(np.maximum(v1, v2) + radius, np.array(dims)).astype(int)
+        unit_vec = vec / dist
+        for z in range(bounding_box_min[0], bounding_box_max[0]):
+            for y in range(bounding_box_min[1], bounding_box_max[1]):
+                for x in range(bounding_box_min[2], bounding_box_max[2]):
+                    voxel_vec = np.array([z, y, x]) - v1
+                    projection = np.dot(unit_vec, voxel_vec)
+                    if 0 <= projection <= dist:
+                        if np.linalg.norm(voxel_vec - unit_vec * projection) <= radius:
+                            voxels.add((z, y, x))
+        return voxels
+
+    dist_mid = dist * 0.5
+    mid = v1 + vec * 0.5
+    max_angle = np.arctan(radius / dist_mid)
+    boundry = max(dist_mid, radius) + 1
+    lo = [int(max(mid[d] - boundry, 0)) for d in range(3)]
+    hi = [int(min(mid[d] + boundry, dims[d])) for d in range(3)]
+    for z in range(lo[0], hi[0]):
+        for y in range(lo[1], hi[1]):
+            for x in range(lo[2], hi[2]):
+                voxel = np.array([z, y, x])
+                if np.linalg.norm(voxel - v2) == 0 or np.linalg.norm(voxel - v1) == 0:
+                    voxels.add((z, y, x))
+                    continue
+                voxel_vec = voxel - v1
+                projection = np.dot(vec / dist, voxel_vec)
+                angle1 = np.arccos(np.clip(projection / np.linalg.norm(voxel_vec), -1, 1))
+                angle2 = np.arccos(np.clip((dist - projection) / np.linalg.norm(voxel - v2), -1, 1))
+                if angle1 <= max_angle and angle2 <= max_angle:
+                    voxels.add((z, y, x))
+    return voxels
+
+
+def is_boundary_tie(voxel, v1, v2, radius, shape):
+    # one of the exact integer membership conditions holds with equality
+    voxel, v1, v2 = [tuple(int(c) for c in p) for p in (voxel, v1, v2)]
+    vec = [b - a for a, b in zip(v1, v2)]
+    w1 = [p - a for p, a in zip(voxel, v1)]
+    w2 = [p - b for p, b in zip(voxel, v2)]
+    dot = lambda a, b: sum(x * y for x, y in zip(a, b))
+    dist_sq = dot(vec, vec)
+    dot_v1 = dot(w1, vec)
+    if shape == 'cylinder':
+        return dot_v1 in (0, dist_sq) or dot(w1, w1) * dist_sq - dot_v1 ** 2 == radius ** 2 * dist_sq
+    cone_sq = dist_sq + 4 * radius ** 2
+    dot_v2 = -dot(w2, vec)
+    return (dot_v1 == 0 or dot_v2 == 0 or dot_v1 ** 2 * cone_sq == dist_sq ** 2 * dot(w1, w1) or
+            dot_v2 ** 2 * cone_sq == dist_sq ** 2 * dot(w2, w2))
+
+
+@pytest.mark.parametrize('shape', ['cylinder', 'cone'])
+def test_matches_reference_up_to_boundary_ties(shape):
+    rng = np.random.default_rng(0)
+    dims = (24, 32, 32)
+    for _ in range(20):
+        v1, v2 = rng.integers(0, dims, size=(2, 3))
+        if np.array_equal(v1, v2):
+            continue
+        radius = int(rng.integers(1, 6))
+        voxels = {tuple(v) for v in get_shape_voxels(v1, v2, radius, dims, shape).tolist()}
+        reference = reference_shape_voxels(v1.astype(float), v2.astype(float), radius, dims, shape)
+        for voxel in voxels ^ reference:
+            assert is_boundary_tie(voxel, v1, v2, radius, shape), (voxel, v1, v2, radius)
+
+
+def test_voxels_are_sorted_and_inside_the_volume():
+    dims = (10, 12, 14)
+    voxels = get_shape_voxels(np.array([0, 0, 0]), np.array([9, 11, 13]), 3, dims, 'cylinder')
+    assert np.all(voxels >= 0) and np.all(voxels < dims)
+    assert np.array_equal(voxels, voxels[np.lexsort(voxels.T[::-1])])
@@ -0,0 +1,143 @@
+import zlib
+
+import numpy as np
+
+from cache import read_volume, write_volume
+from jobs import no_progress
+
+VOLUME_SLAB_BYTES = 2 ** 24
+COMPRESSIONS = ['gzip', 'zstd']
+# level k is downsampled by 2 ** k along every axis
+PYRAMID_LEVELS = [1, 2, 3]
+
+
+def resolve_channel(f, name):
+    if name == 'first':
+        return list(f['image'].keys())[0]
+    if name not in f['image'].keys():
+        return None
+    return name
+
+
+def to_uint8(volume):
+    if volume.dtype == np.uint8:
+        return np.asarray(volume)
+    return np.array(np.asarray(volume, dtype=np.float32) * 255, dtype=np.uint8)
+
+
+def get_level_dataset(f, channel, level=0):
+    if level == 0:
+        return f['image'][channel]
+    if 'pyramid' not in f.keys() or str(level) not in f['pyramid'].keys() or \
+            channel not in f['pyramid'][str(level)].keys():
+        return None
+    return f['pyramid'][str(level)][channel]
+
+
+def downsample(block, factor=2):
+    # mean over factor^3 blocks, trailing partial blocks are padded by replicating the border
+    pad = [(0, -s % factor) for s in block.shape]
+    if any(p[1] for p in pad):
+        block = np.pad(block, pad, mode='edge')
+    z, y, x = block.shape
+    block = block.reshape(z // factor, factor, y // factor, factor, x // factor, factor)
+    return block.mean(axis=(1, 3, 5), dtype=np.float32)
+
+
+def iter_downsampled(dataset, factor):
+    slab_depth = factor * max(1, VOLUME_SLAB_BYTES // (int(np.prod(dataset.shape[1:])) * 4 * factor))
+    for z in range(0, dataset.shape[0], slab_depth):
+        yield downsample(np.asarray(dataset[z:z + slab_depth], dtype=np.float32), factor)
+
+
+def build_pyramid(volume_path, channels=None, levels=PYRAMID_LEVELS, progress=no_progress):
+    # one pass over each channel: every z-slab is reduced level by level from the previous level. Slabs are read
+    # through the shared handle and written under a short write lock into <channel>.part datasets, which replace
+    # the levels of the channel once complete, so readers of the volume are only held up per slab
+    with read_volume(volume_path) as f:
+        if channels is None:
+            channels = list(f['image'].keys())
+        shapes = [f['image'][channel].shape for channel in channels]
+    depth = 2 ** max(levels)
+    part = '{}.part'
+    for c, (channel, shape) in enumerate(zip(channels, shapes)):
+        level_shapes = {}
+        level_shape = shape
+        for level in range(1, max(levels) + 1):
+            level_shape = tuple(-(-s // 2) for s in level_shape)
+            if level in levels:
+                level_shapes[level] = level_shape
+        with write_volume(volume_path, datasets=['pyramid']) as f:
+            pyramid = f.require_group('pyramid')
+            for level, level_shape in level_shapes.items():
+                group = pyramid.require_group(str(level))
+                if part.format(channel) in group.keys():
+                    del group[part.format(channel)]
+                group.create_dataset(part.format(channel), shape=level_shape, dtype=np.uint8, chunks=True)
+
+        slab_depth = depth * max(1, VOLUME_SLAB_BYTES // (int(np.prod(shape[1:])) * 4 * depth))
+        for z in range(0, shape[0], slab_depth):
+            with read_volume(volume_path) as f:
+                block = np.asarray(f['image'][channel][z:z + slab_depth], dtype=np.float32)
+            blocks = {}
+            for level in range(1, max(levels) + 1):
+                block = downsample(block)
+                if level in level_shapes:
+                    blocks[level] = to_uint8(block)
+            with write_volume(volume_path, datasets=['pyramid']) as f:
+                for level, block in blocks.items():
+                    z_level = z // 2 ** level
+                    f['pyramid'][str(level)][part.format(channel)][z_level:z_level + block.shape[0]] = block
+            progress((c + min(z + slab_depth, shape[0]) / shape[0]) / len(channels),
+                     'Downsampling channel {}'.format(channel))
+
+        with write_volume(volume_path, datasets=['pyramid']) as f:
+            for level in level_shapes:
+                group = f['pyramid'][str(level)]
+                if channel in group.keys():
+                    del group[channel]
+                group.move(part.format(channel), channel)
+    return len(channels)
+
+
+def read_region(dataset, starts, stops):
+    # dataset[starts:stops] as float32, zero filled where the region extends past the dataset;
+    # only the overlapping hyperslab is read
+    starts, stops = np.asarray(starts, dtype=int), np.asarray(stops, dtype=int)
+    region = np.zeros(np.maximum(stops - starts, 0), dtype=np.float32)
+    lo = np.clip(starts, 0, dataset.shape)
+    hi = np.clip(stops, 0, dataset.shape)
+    if np.all(hi > lo):
+        source = tuple(slice(l, h) for l, h in zip(lo, hi))
+        target = tuple(slice(l - s, h - s) for l, h, s in zip(lo, hi, starts))
+        region[target] = dataset[source]
+    return region
+
+
+def get_compressor(compression):
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError("Invalid compression")
+
+
+def iter_volume_bytes(volume_path, channel, compression=None, level=0):
+    # stream the channel (or one of its pyramid levels) as raw C-order uint8 bytes, one z-slab at a time
+    compressor = get_compressor(compression)
+    with read_volume(volume_path) as f:
+        shape = get_level_dataset(f, channel, level).shape
+    slab_depth = max(1, VOLUME_SLAB_BYTES // int(np.prod(shape[1:])))
+
+    for z in range(0, shape[0], slab_depth):
+        with read_volume(volume_path) as f:
+            slab = to_uint8(get_level_dataset(f, channel, level)[z:z + slab_depth]).tobytes()
+        if compressor is not None:
+            slab = compressor.compress(slab)
+        if slab:
+            yield slab
+    if compressor is not None:
+        yield compressor.flush()